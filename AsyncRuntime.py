@@ -0,0 +1,144 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from EventQueue import EventQueue
+from Metrics import metrics
+
+
+class AsyncRuntime:
+    """
+        Runs the bot on an asyncio event loop.
+        The RTM websocket is registered with the loop so events are read as soon as they
+        arrive instead of polling. Every event is dispatched as its own task and the blocking
+        calls to Watson, Google and Slack in handle_command run on a bounded thread pool,
+        so a slow request of one user does not delay the others. Events wait in a bounded
+        EventQueue until a worker is free, which also keeps messages of the same user in order.
+        If reading from slack fails the websocket is reconnected. If that fails as well the loop
+        is stopped, so the process exits and can be restarted instead of running without events.
+    """
+    logger = logging.getLogger(__name__)
+
+    MAX_WORKERS = 8
+    # Only used if the websocket of the slack client can not be watched directly
+    FALLBACK_READ_DELAY = 0.1
+
+    def __init__(self, bot, max_workers=MAX_WORKERS, loop=None, queue=None):
+        self.bot = bot
+        self.loop = loop or asyncio.get_event_loop()
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.queue = queue or EventQueue()
+        self._running_tasks = 0
+        self._socket = None
+        self._fd = None
+        metrics.gauge("event_queue_backlog", lambda: self.queue.backlog)
+        metrics.gauge("event_queue_dropped", lambda: self.queue.dropped)
+        metrics.gauge("running_tasks", lambda: self._running_tasks)
+
+    def run(self, read_slack=True):
+        """
+        :param read_slack: False if the events are passed to dispatch by someone else, like the front process of a shard
+        """
+        if read_slack:
+            self._watch_websocket()
+        try:
+            self.loop.run_forever()
+        finally:
+            self._unwatch_websocket()
+            self.executor.shutdown(wait=False)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    @property
+    def idle(self):
+        return not self._running_tasks and not self.queue.backlog
+
+    def _websocket(self):
+        server = getattr(self.bot.slack_client, "server", None)
+        websocket = getattr(server, "websocket", None)
+        return getattr(websocket, "sock", None)
+
+    def _watch_websocket(self):
+        sock = self._websocket()
+        if sock is None:
+            self.logger.warning("Could not watch slack websocket. Polling every {}s".format(self.FALLBACK_READ_DELAY))
+            self.loop.call_later(self.FALLBACK_READ_DELAY, self._poll)
+            return
+        self._socket = sock
+        # Kept because a closed socket returns -1 as its fileno
+        self._fd = sock.fileno()
+        self.loop.add_reader(self._fd, self._read_events)
+
+    def _unwatch_websocket(self):
+        if self._socket is not None:
+            self.loop.remove_reader(self._fd)
+            self._socket = None
+            self._fd = None
+
+    def _poll(self):
+        if self._read_events():
+            self.loop.call_later(self.FALLBACK_READ_DELAY, self._poll)
+
+    def _read_events(self):
+        """
+        :return: False if reading failed and the events are read by a new watch or not at all
+        """
+        while True:
+            try:
+                events = self.bot.slack_client.rtm_read()
+            except Exception:
+                self.logger.exception("Could not read from slack")
+                self._reconnect()
+                return False
+            self.dispatch(events)
+            if self._socket is not None and self._socket is not self._websocket():
+                # The slack client reconnected, watch the new websocket instead
+                self._unwatch_websocket()
+                self._watch_websocket()
+                return False
+            # Decrypted data buffered by SSL does not make the socket readable again
+            pending = getattr(self._socket, "pending", None)
+            if not events or pending is None or not pending():
+                return True
+
+    def _reconnect(self):
+        """
+            Stop watching the broken websocket, otherwise the loop keeps calling _read_events for it.
+            Watch the new websocket after reconnecting or stop the loop.
+        """
+        self._unwatch_websocket()
+        metrics.inc("slack_reconnects_total")
+        if self.bot.slack_client.rtm_connect(with_team_state=False, reconnect=True):
+            self.logger.info("Reconnected to slack")
+            self._watch_websocket()
+        else:
+            self.logger.error("Could not reconnect to slack. Stopping")
+            self.loop.stop()
+
+    def dispatch(self, events):
+        for event in self.bot.parse_slack_output(events):
+            if not self.queue.put(event[2], event):
+                self.logger.warning("Event queue is full. Dropped event of user {}".format(event[2]))
+        self._start_tasks()
+
+    def _start_tasks(self):
+        while self._running_tasks < self.max_workers:
+            item = self.queue.get()
+            if item is None:
+                return
+            self._running_tasks += 1
+            self.loop.create_task(self._handle(*item))
+
+    async def _handle(self, user, event):
+        command, channel, _, is_AT_bot = event
+        try:
+            await self.loop.run_in_executor(self.executor, self.bot.handle_command,
+                                            command, user, channel, is_AT_bot)
+        except Exception:
+            self.logger.exception("Could not handle command of user {}".format(user))
+        finally:
+            self._running_tasks -= 1
+            self.queue.task_done(user)
+            self._start_tasks()
@@ -0,0 +1,75 @@
+import hashlib
+import json
+import logging
+import os
+
+from Metrics import metrics
+
+
+class BotIdentity:
+    """
+        Slack user id of the bot, resolved with a single auth.test call instead of
+        downloading the whole member list. The id is cached in a file next to VERSION,
+        keyed by a hash of the token, so restarts with the same token need no call at all.
+    """
+    logger = logging.getLogger(__name__)
+
+    FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "BOT_IDENTITY")
+
+    def __init__(self, token, path=FILE):
+        self.path = path
+        self.token_hash = hashlib.sha256((token or "").encode("utf-8")).hexdigest()
+
+    def load(self):
+        """
+        :return: the cached user id or None if there is no cache for the token
+        """
+        try:
+            with open(self.path) as f:
+                identity = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if identity.get("token") != self.token_hash:
+            return None
+        return identity.get("user_id")
+
+    def save(self, user_id, name=None):
+        try:
+            with open(self.path, "w") as f:
+                json.dump({"token": self.token_hash, "user_id": user_id, "user": name}, f)
+        except IOError as e:
+            # A read-only file system only costs the auth.test call on the next start
+            self.logger.warning("Could not cache bot identity in {}: {}".format(self.path, e))
+
+    def resolve(self, slack_client):
+        """
+            Return the cached user id or ask slack with auth.test and cache the answer.
+        :return: the user id of the bot or None if auth.test failed
+        """
+        user_id = self.load()
+        if user_id:
+            return user_id
+        with metrics.timer("upstream", endpoint="slack.auth.test") as timer:
+            response = slack_client.api_call("auth.test")
+            if not response or not response.get('ok'):
+                timer.fail()
+        if not response or not response.get('ok'):
+            self.logger.error("Could not identify bot with auth.test: {}".format((response or {}).get('error')))
+            return None
+        self.save(response['user_id'], response.get('user'))
+        return response['user_id']
+
+
+if __name__ == "__main__":
+    # Called by build.sh to ship the identity with the app, so even the first start skips auth.test
+    import sys
+    from urllib.request import Request, urlopen
+    token = os.environ.get('SLACK_BOT_TOKEN')
+    if not token:
+        sys.exit("No environment variable \"SLACK_BOT_TOKEN\" found.")
+    request = Request("https://slack.com/api/auth.test", data=b"", headers={"Authorization": "Bearer " + token})
+    response = json.loads(urlopen(request, timeout=10).read().decode("utf-8"))
+    if not response.get('ok'):
+        sys.exit("Could not identify bot with auth.test: {}".format(response.get('error')))
+    BotIdentity(token).save(response['user_id'], response.get('user'))
+    print("Cached bot identity {}".format(response['user_id']))
@@ -0,0 +1,73 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class DistanceCache:
+    """
+        LRU cache for distance matrix results.
+        Locations are rounded so nearby coordinates share an entry. Every result holds the
+        traffic dependent duration_in_traffic, so entries expire after the short TTL.
+    """
+
+    # 3 decimal places are roughly 100m
+    PRECISION = 3
+    TTL = 60.0
+    MAX_ENTRIES = 10000
+
+    def __init__(self, precision=PRECISION, ttl=TTL, max_entries=MAX_ENTRIES):
+        self.precision = precision
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, origin, destination, mode, traffic_model):
+        return self._quantize(origin), self._quantize(destination), mode, traffic_model
+
+    def _quantize(self, location):
+        if isinstance(location, dict):
+            return round(location["lat"], self.precision), round(location["lng"], self.precision)
+        if isinstance(location, (tuple, list)):
+            return round(location[0], self.precision), round(location[1], self.precision)
+        return " ".join(str(location).lower().split())
+
+    def get(self, key):
+        """
+        :return: the cached result or None
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                result, expires = entry
+                if expires <= now:
+                    del self._entries[key]
+                else:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return result
+            self.misses += 1
+            return None
+
+    def put(self, key, result):
+        now = time.time()
+        with self._lock:
+            self._entries[key] = (result, now + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
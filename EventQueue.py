@@ -0,0 +1,70 @@
+import threading
+from collections import OrderedDict, deque
+
+
+class EventQueue:
+    """
+        Bounded queue of slack events between parsing and handle_command.
+        Events of the same user are handed out one at a time and in order, while
+        events of different users are served round robin. If the queue is full,
+        new events are dropped and counted.
+    """
+
+    MAX_SIZE = 1000
+
+    def __init__(self, maxsize=MAX_SIZE):
+        self.maxsize = maxsize
+        self.received = 0
+        self.dropped = 0
+        self.max_backlog = 0
+        self._size = 0
+        self._queues = {}
+        self._ready = OrderedDict()
+        self._active = set()
+        self._lock = threading.Lock()
+
+    def put(self, user, event):
+        """
+        :return: False if the event was dropped because the queue is full
+        """
+        with self._lock:
+            self.received += 1
+            if self._size >= self.maxsize:
+                self.dropped += 1
+                return False
+            self._queues.setdefault(user, deque()).append(event)
+            if user not in self._active:
+                self._ready[user] = None
+            self._size += 1
+            self.max_backlog = max(self.max_backlog, self._size)
+            return True
+
+    def get(self):
+        """
+            Take the next event of a user which has no event in progress.
+            task_done has to be called for the user once the event was handled.
+        :return: tuple (user, event) or None if no event can be handled right now
+        """
+        with self._lock:
+            if not self._ready:
+                return None
+            user, _ = self._ready.popitem(last=False)
+            event = self._queues[user].popleft()
+            self._active.add(user)
+            self._size -= 1
+            return user, event
+
+    def task_done(self, user):
+        with self._lock:
+            self._active.discard(user)
+            if self._queues.get(user):
+                self._ready[user] = None
+            else:
+                self._queues.pop(user, None)
+
+    @property
+    def backlog(self):
+        return self._size
+
+    def __len__(self):
+        return self._size
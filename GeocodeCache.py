@@ -0,0 +1,140 @@
+import json
+import re
+import sqlite3
+import threading
+import time
+
+
+class GeocodeCache:
+    """
+        Persistent SQLite cache for geocode lookups which survives restarts of the bot.
+        Entries are keyed by the normalized query text. Each query is additionally split
+        into tokens which are indexed so earlier results can be found by prefix.
+        All shard processes share the file. It is opened in WAL mode so reads do not block
+        on writes of other processes and writers wait up to BUSY_TIMEOUT for each other.
+    """
+    MAX_ENTRIES = 5000
+    MAX_AGE = 60.0 * 60 * 24 * 30
+    # Queries without results are only remembered shortly, they may be typos or transient failures
+    NEGATIVE_MAX_AGE = 60.0 * 10
+    SOURCE_GEOCODE = "geocode"
+    SOURCE_PLACES = "places"
+    SOURCE_NONE = "none"
+    BUSY_TIMEOUT = 5.0
+
+    def __init__(self, path, max_entries=MAX_ENTRIES, max_age=MAX_AGE, negative_max_age=NEGATIVE_MAX_AGE):
+        """
+        :param path: file of the SQLite database, ":memory:" for a cache which is not persisted
+        :param negative_max_age: max age of entries without locations
+        """
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.negative_max_age = negative_max_age
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=self.BUSY_TIMEOUT, check_same_thread=False)
+        # Ignored by in-memory databases
+        self._connection.execute("PRAGMA journal_mode = WAL")
+        with self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS geocodes ("
+                                     "query TEXT PRIMARY KEY, source TEXT, locations TEXT, "
+                                     "created REAL, last_used REAL)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS tokens ("
+                                     "token TEXT, query TEXT, PRIMARY KEY (token, query))")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS geocodes_last_used ON geocodes (last_used)")
+
+    @staticmethod
+    def normalize(query):
+        return " ".join(GeocodeCache.tokenize(query))
+
+    @staticmethod
+    def tokenize(query):
+        return re.findall(r"\w+", query.lower())
+
+    def get(self, query):
+        """
+        :return: tuple (source, locations) or None if the query is not cached or expired
+        """
+        key = self.normalize(query)
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute("SELECT source, locations, created FROM geocodes WHERE query = ?",
+                                           (key,)).fetchone()
+            if row is None or row[2] + self._max_age(row[0]) <= now:
+                if row is not None:
+                    self._delete(key)
+                self.misses += 1
+                return None
+            with self._connection:
+                self._connection.execute("UPDATE geocodes SET last_used = ? WHERE query = ?", (now, key))
+            self.hits += 1
+            return row[0], json.loads(row[1])
+
+    def _max_age(self, source):
+        return self.negative_max_age if source == self.SOURCE_NONE else self.max_age
+
+    def put(self, query, source, locations):
+        key = self.normalize(query)
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?, ?)",
+                                     (key, source, json.dumps(locations or []), now, now))
+            self._connection.executemany("INSERT OR IGNORE INTO tokens VALUES (?, ?)",
+                                         [(token, key) for token in set(key.split())])
+            self._evict()
+
+    def search(self, prefix, limit=10):
+        """
+            Find locations of earlier queries in which every token of prefix starts one of their tokens.
+        :return: list of locations, without duplicate addresses
+        """
+        tokens = self.tokenize(prefix)
+        if not tokens:
+            return []
+        now = time.time()
+        with self._lock:
+            queries = None
+            for token in tokens:
+                rows = self._connection.execute("SELECT query FROM tokens WHERE token >= ? AND token < ?",
+                                                (token, token + "\uffff")).fetchall()
+                matches = {row[0] for row in rows}
+                queries = matches if queries is None else queries & matches
+                if not queries:
+                    return []
+            locations = []
+            addresses = set()
+            for query in sorted(queries):
+                row = self._connection.execute("SELECT locations, created FROM geocodes WHERE query = ?",
+                                               (query,)).fetchone()
+                if row is None or row[1] + self.max_age <= now:
+                    continue
+                for location in json.loads(row[0]):
+                    if location["address"] not in addresses:
+                        addresses.add(location["address"])
+                        locations.append(location)
+                        if len(locations) >= limit:
+                            return locations
+            return locations
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM geocodes").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _delete(self, key):
+        with self._connection:
+            self._connection.execute("DELETE FROM geocodes WHERE query = ?", (key,))
+            self._connection.execute("DELETE FROM tokens WHERE query = ?", (key,))
+
+    def _evict(self):
+        count = self._connection.execute("SELECT COUNT(*) FROM geocodes").fetchone()[0]
+        if count <= self.max_entries:
+            return
+        oldest = self._connection.execute("SELECT query FROM geocodes ORDER BY last_used LIMIT ?",
+                                           (count - self.max_entries,)).fetchall()
+        self._connection.executemany("DELETE FROM geocodes WHERE query = ?", oldest)
+        self._connection.executemany("DELETE FROM tokens WHERE query = ?", oldest)
@@ -1,43 +1,188 @@
-import googlemaps
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
+
+from DistanceCache import DistanceCache
+from GeocodeCache import GeocodeCache
+from HttpTransport import HttpTransport
+from Metrics import metrics
+from RateLimiter import RateLimiter
 
 class GoogleWrapper:
+    MODE = "driving"
+    TRAFFIC_MODEL = "best_guess"
+    # Parallel requests of all departure time forecasts together
+    FORECAST_WORKERS = 6
+
+    GEOCODE_CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "geocode_cache.sqlite")
+
+    def __init__(self, key=os.environ.get('GOOGLE_MAPS_API_TOKEN'), cache=None, geocode_cache=None, client=None,
+                 limiter=None, transport=None):
+        """
+        :param client: googlemaps.Client compatible client, created from key if not given
+        :param limiter: RateLimiter shared with the other upstream calls of the bot
+        :param transport: HttpTransport shared with the other upstream clients of the bot
+        """
+        self.transport = transport if transport is not None else HttpTransport.from_environment()
+        self.key = key
+        # googlemaps is only imported and the client only created on the first query
+        self._client = client
+        self._client_lock = threading.Lock()
+        if client is not None:
+            self.transport.attach(client)
+        self.limiter = limiter if limiter is not None else RateLimiter.from_environment()
+        if cache is None:
+            cache = DistanceCache(ttl=float(os.environ.get('DISTANCE_CACHE_TTL', DistanceCache.TTL)))
+        self.distance_cache = cache
+        if geocode_cache is None:
+            geocode_cache = GeocodeCache(os.environ.get('GEOCODE_CACHE_FILE', self.GEOCODE_CACHE_FILE))
+        self.geocode_cache = geocode_cache
+        # Answer unknown queries with the locations of earlier queries starting with the same words
+        self.geocode_prefix_match = os.environ.get('GEOCODE_PREFIX_MATCH', '').lower() in ('1', 'true', 'yes')
+        # Shared by concurrent forecasts, so they queue up instead of starting threads each
+        self._forecast_executor = ThreadPoolExecutor(max_workers=self.FORECAST_WORKERS,
+                                                     thread_name_prefix="GoogleForecast")
+        metrics.gauge("distance_cache_hits", lambda: self.distance_cache.hits)
+        metrics.gauge("distance_cache_misses", lambda: self.distance_cache.misses)
+
+    @property
+    def gmaps(self):
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    client = self._create_client()
+                    self.transport.attach(client)
+                    self._client = client
+        return self._client
+
+    def _create_client(self):
+        """
+            googlemaps.Client which leaves all retries to the RateLimiter, so a failing call
+            is not retried by both. Server errors raise HTTPError instead of being retried.
+        """
+        import googlemaps
+        transport = self.transport
+
+        class SingleAttemptClient(googlemaps.Client):
 
-    def __init__(self, key=os.environ.get('GOOGLE_MAPS_API_TOKEN')):
-        self.gmaps = googlemaps.Client(key)
+            def _request(self, url, params, first_request_time=None, retry_counter=0, *args, **kwargs):
+                # The client calls itself again with a higher retry_counter to retry 5xx responses
+                if retry_counter > 0:
+                    raise googlemaps.exceptions.HTTPError(transport.last_status)
+                return super()._request(url, params, first_request_time, retry_counter, *args, **kwargs)
+
+        return SingleAttemptClient(self.key, connect_timeout=self.transport.connect_timeout,
+                                   read_timeout=self.transport.read_timeout, retry_over_query_limit=False)
 
     def get_distance_matrix(self, origin, destination):
-        now = datetime.now()
-        matrix = self.gmaps.distance_matrix(origin,
-                                            destination,
-                                            mode="driving",
-                                            departure_time=now,
-                                            language="de",
-                                            traffic_model = "best_guess")
-        distance = matrix['rows'][0]['elements'][0]['distance']
-        duration = matrix['rows'][0]['elements'][0]['duration']
-        duration_in_traffic = matrix['rows'][0]['elements'][0]['duration_in_traffic']
+        return self.get_distance_matrices([origin], [destination])[0][0]
+
+    def get_distance_matrices(self, origins, destinations):
+        """
+            Query the travel times between all origins and destinations with a single request.
+            Pairs found in the distance cache are not queried again.
+        :return: list of rows, one per origin, each holding one result per destination or None if there is no route
+        """
+        results = [[None] * len(destinations) for _ in origins]
+        missing_origins = []
+        missing_destinations = []
+        for i, origin in enumerate(origins):
+            for j, destination in enumerate(destinations):
+                cached = self.distance_cache.get(self._cache_key(origin, destination))
+                if cached is not None:
+                    results[i][j] = cached
+                else:
+                    if i not in missing_origins:
+                        missing_origins.append(i)
+                    if j not in missing_destinations:
+                        missing_destinations.append(j)
+        if not missing_origins:
+            return results
+
+        matrix = self._query_distance_matrix([origins[i] for i in missing_origins],
+                                             [destinations[j] for j in missing_destinations],
+                                             datetime.now())
+        for i, row in zip(missing_origins, matrix):
+            for j, result in zip(missing_destinations, row):
+                if result is not None:
+                    self.distance_cache.put(self._cache_key(origins[i], destinations[j]), result)
+                results[i][j] = result
+        return results
+
+    def get_departure_forecast(self, origin, destination, departure_times):
+        """
+            Query the predicted travel times for several future departure times in parallel.
+        :param departure_times: datetimes or unix timestamps in the future
+        :return: list with one result per departure time
+        """
+        lane = RateLimiter.current_lane()
+
+        def query(departure_time):
+            with RateLimiter.lane(lane):
+                return self._query_distance_matrix([origin], [destination], departure_time)
+
+        return [matrix[0][0] for matrix in self._forecast_executor.map(query, departure_times)]
+
+    def _query_distance_matrix(self, origins, destinations, departure_time):
+        with metrics.timer("upstream", endpoint="google.distance_matrix"):
+            matrix = self.limiter.call("google", partial(self.gmaps.distance_matrix,
+                                                         origins,
+                                                         destinations,
+                                                         mode=self.MODE,
+                                                         departure_time=departure_time,
+                                                         language="de",
+                                                         traffic_model = self.TRAFFIC_MODEL))
+        metrics.inc("distance_matrix_elements_total", len(origins) * len(destinations))
+        return [[self._parse_element(element) for element in row['elements']] for row in matrix['rows']]
+
+    def _cache_key(self, origin, destination):
+        return self.distance_cache.key(origin, destination, self.MODE, self.TRAFFIC_MODEL)
+
+    def _parse_element(self, element):
+        """
+        :return: None if google found no route, e.g. with status ZERO_RESULTS or NOT_FOUND
+        """
+        status = element.get('status', 'OK')
+        if status != 'OK':
+            metrics.inc("distance_matrix_element_errors_total", status=status)
+            return None
+        distance = element['distance']
+        duration = element['duration']
+        # Without traffic data for the route there is only the usual duration
+        duration_in_traffic = element.get('duration_in_traffic', duration)
         return {"distance": distance, "duration": duration, "duration_in_traffic": duration_in_traffic}
 
     def get_geocode_for_location(self, location_name):
-        result = self.gmaps.geocode(location_name)
-        locations = []
-        if len(result) > 0:
-            for place in result:
-                location = {}
-                location["address"] = place["formatted_address"]
-                location["geocode"] = place["geometry"]["location"]
-                locations.append(location)
-            return locations
-        else:
-            result = self.gmaps.places(location_name)
-            if len(result["results"]) > 0:
-                for place in result["results"]:
-                    location = {}
-                    location["address"] = place["formatted_address"]
-                    location["geocode"] = place["geometry"]["location"]
-                    locations.append(location)
+        cached = self.geocode_cache.get(location_name)
+        if cached is not None:
+            return cached[1] or None
+        if self.geocode_prefix_match:
+            locations = self.geocode_cache.search(location_name)
+            if len(locations) > 1:
                 return locations
-            else:
-                return None
\ No newline at end of file
+
+        source, locations = self._query_geocode(location_name)
+        self.geocode_cache.put(location_name, source, locations)
+        return locations or None
+
+    def _query_geocode(self, location_name):
+        with metrics.timer("upstream", endpoint="google.geocode"):
+            result = self.limiter.call("google", partial(self.gmaps.geocode, location_name))
+        if len(result) > 0:
+            return GeocodeCache.SOURCE_GEOCODE, self._parse_places(result)
+        with metrics.timer("upstream", endpoint="google.places"):
+            result = self.limiter.call("google", partial(self.gmaps.places, location_name))
+        if len(result["results"]) > 0:
+            return GeocodeCache.SOURCE_PLACES, self._parse_places(result["results"])
+        return GeocodeCache.SOURCE_NONE, []
+
+    def _parse_places(self, places):
+        locations = []
+        for place in places:
+            location = {}
+            location["address"] = place["formatted_address"]
+            location["geocode"] = place["geometry"]["location"]
+            locations.append(location)
+        return locations
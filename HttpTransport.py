@@ -0,0 +1,192 @@
+import logging
+import os
+import threading
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from Metrics import metrics
+
+
+class HttpTransport:
+    """
+        One HTTP transport for the Google Maps and Slack clients, which also lends its timeouts
+        to the Watson client. Connections are kept alive in a pool per host, every request gets
+        connect and read timeouts unless the caller set its own, and requests can go over HTTP/2
+        with httpx if it is installed. The reuse of pooled connections is exported as metrics.
+    """
+    logger = logging.getLogger(__name__)
+
+    CONNECT_TIMEOUT = 3.05
+    READ_TIMEOUT = 10.0
+    POOL_SIZE = 10
+    # Larger pools for hosts called from many threads at once
+    POOL_SIZES = {
+        "maps.googleapis.com": 20,
+    }
+
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, pool_size=POOL_SIZE,
+                 pool_sizes=None, http2=False):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        self._adapters = {}
+        self.session.mount("https://", self._adapter("default", pool_size))
+        self.session.mount("http://", self._adapter("default", pool_size))
+        for host, size in (self.POOL_SIZES if pool_sizes is None else pool_sizes).items():
+            self.session.mount("https://{}/".format(host), self._adapter(host, size))
+        self._http2_client = self._create_http2_client() if http2 else None
+        self._timeout_errors = (requests.exceptions.Timeout,)
+        if self._http2_client is not None:
+            import httpx
+            self._timeout_errors += (httpx.TimeoutException,)
+        self._hosts = set()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @classmethod
+    def from_environment(cls):
+        return cls(connect_timeout=float(os.environ.get('HTTP_CONNECT_TIMEOUT', cls.CONNECT_TIMEOUT)),
+                   read_timeout=float(os.environ.get('HTTP_READ_TIMEOUT', cls.READ_TIMEOUT)),
+                   pool_size=int(os.environ.get('HTTP_POOL_SIZE', cls.POOL_SIZE)),
+                   http2=os.environ.get('HTTP2', '').lower() in ('1', 'true', 'yes'))
+
+    def _adapter(self, name, size):
+        adapter = HTTPAdapter(pool_connections=size, pool_maxsize=size)
+        self._adapters[name] = adapter
+        return adapter
+
+    def _create_http2_client(self):
+        try:
+            import httpx
+            import h2  # noqa: F401 httpx needs it for HTTP/2
+        except ImportError:
+            self.logger.warning("HTTP2 requested but httpx[http2] is not installed. Using HTTP/1.1")
+            return None
+        return httpx.Client(http2=True, limits=httpx.Limits(max_keepalive_connections=self.pool_size))
+
+    @property
+    def timeout(self):
+        return self.connect_timeout, self.read_timeout
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        host = urlparse(url).hostname
+        self._track(host)
+        try:
+            if self._http2_client is not None:
+                response = self._http2_request(method, url, **kwargs)
+            else:
+                response = self.session.request(method, url, **kwargs)
+        except self._timeout_errors:
+            metrics.inc("http_timeouts_total", host=host)
+            raise
+        self._local.status = response.status_code
+        return response
+
+    @property
+    def last_status(self):
+        """
+        :return: HTTP status of the last response received by the calling thread or None
+        """
+        return getattr(self._local, "status", None)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def _http2_request(self, method, url, **kwargs):
+        import httpx
+        timeout = kwargs.pop("timeout")
+        connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        # Options of requests without a counterpart in httpx
+        for name in ("proxies", "verify", "allow_redirects", "stream", "cert"):
+            kwargs.pop(name, None)
+        if isinstance(kwargs.get("data"), (str, bytes)):
+            kwargs["content"] = kwargs.pop("data")
+        return self._http2_client.request(method, url, timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                                          **kwargs)
+
+    def _track(self, host):
+        metrics.inc("http_requests_total", host=host)
+        if host in self._hosts:
+            return
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts.add(host)
+                metrics.gauge("http_connections_opened", lambda: self.stats().get(host, {}).get("connections", 0),
+                              host=host)
+                metrics.gauge("http_connections_reused", lambda: self.stats().get(host, {}).get("reused", 0),
+                              host=host)
+
+    def stats(self):
+        """
+            Connection reuse of the HTTP/1.1 pools.
+        :return: dict of host to the number of opened connections, requests and requests on a reused connection
+        """
+        stats = {}
+        for adapter in self._adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                entry = stats.setdefault(pool.host, {"connections": 0, "requests": 0})
+                entry["connections"] += pool.num_connections
+                entry["requests"] += pool.num_requests
+        for entry in stats.values():
+            entry["reused"] = max(0, entry["requests"] - entry["connections"])
+        return stats
+
+    def attach(self, client):
+        """
+            Route the HTTP requests of a client with a requests session attribute, like googlemaps.Client,
+            through this transport.
+        :return: False if client has no requests session
+        """
+        if isinstance(getattr(client, "session", None), requests.Session):
+            client.session = self
+            return True
+        return False
+
+    def attach_slack(self, api_requester):
+        """
+            Send the Web API calls of a slackclient SlackRequest through this transport.
+            SlackRequest posts with the requests module itself, so its post_http_request is replaced
+            on this instance with one building the same request.
+        """
+        def post_http_request(token, api_method, post_data, files=None, timeout=None, domain="slack.com"):
+            if post_data is not None and "token" in post_data:
+                token = post_data['token']
+            headers = {
+                'user-agent': api_requester.get_user_agent(),
+                'Authorization': 'Bearer {}'.format(token)
+            }
+            return self.post("https://{0}/api/{1}".format(domain, api_method), headers=headers, data=post_data,
+                             files=files, timeout=timeout, proxies=api_requester.proxies)
+
+        api_requester.post_http_request = post_http_request
+
+    def attach_timeouts(self, client):
+        """
+            Add the timeouts of this transport to the requests of a client whose request method passes
+            extra keyword arguments on to the requests module, like the watson_developer_cloud services.
+            The client keeps opening its own connections.
+        """
+        request = client.request
+
+        def request_with_timeout(*args, **kwargs):
+            kwargs.setdefault("timeout", self.timeout)
+            return request(*args, **kwargs)
+
+        client.request = request_with_timeout
+
+    def close(self):
+        self.session.close()
+        if self._http2_client is not None:
+            self._http2_client.close()
@@ -0,0 +1,89 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+
+class IntentClassifier:
+    """
+        Classifies messages locally before falling back to Watson.
+        Plain numbers are answers to the conversation state machine and have no intent.
+        Other messages are matched against the regular expressions of the PATTERNS section
+        in intents.conf. Only if no rule matches Watson is asked and its answer is cached.
+    """
+    CACHE_SIZE = 1000
+    PATTERNS_SECTION = "PATTERNS"
+    NUMBER = re.compile(r"^\d+$")
+
+    def __init__(self, intents, remote_classifier, cache_size=CACHE_SIZE):
+        """
+        :param intents: ConfigParser of intents.conf
+        :param remote_classifier: callable returning the intent of a text, e.g. the Watson lookup
+        """
+        self.remote_classifier = remote_classifier
+        self.cache_size = cache_size
+        self.rules = self._load_rules(intents)
+        self.local_hits = 0
+        self.cache_hits = 0
+        self.remote_calls = 0
+        self.remote_time = 0.0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _load_rules(self, intents):
+        rules = []
+        if not intents.has_section(self.PATTERNS_SECTION):
+            return rules
+        defaults = intents.defaults()
+        for name, intent in defaults.items():
+            pattern = intents.get(self.PATTERNS_SECTION, name, raw=True, fallback=None)
+            # Options of DEFAULT are inherited by every section
+            if not pattern or pattern == intent:
+                continue
+            rules.append((re.compile(pattern, re.IGNORECASE), intent))
+        return rules
+
+    @staticmethod
+    def normalize(text):
+        return " ".join(text.lower().split())
+
+    def classify(self, text):
+        """
+        :return: the intent of text or None if it has no known intent
+        """
+        key = self.normalize(text)
+        if self.NUMBER.match(key):
+            self.local_hits += 1
+            return None
+        for pattern, intent in self.rules:
+            if pattern.search(key):
+                self.local_hits += 1
+                return intent
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return self._cache[key]
+
+        start = time.time()
+        intent = self.remote_classifier(text)
+        with self._lock:
+            self.remote_calls += 1
+            self.remote_time += time.time() - start
+            self._cache[key] = intent
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return intent
+
+    @property
+    def avoided_calls(self):
+        return self.local_hits + self.cache_hits
+
+    @property
+    def saved_time(self):
+        """
+            Estimated time saved by not calling the remote classifier, based on its average latency.
+        """
+        if not self.remote_calls:
+            return 0.0
+        return self.avoided_calls * self.remote_time / self.remote_calls
@@ -0,0 +1,119 @@
+import ast
+import configparser
+import logging
+import os
+import string
+import threading
+import time
+
+
+class MessageCatalogError(ValueError):
+    pass
+
+
+class MessageCatalog:
+    """
+        Reply templates loaded from messages.conf.
+        Every template is parsed and validated once when the file is loaded, so rendering
+        a reply is only a lookup and a format call. The DEFAULT section holds the German
+        texts, other sections are locales which fall back to DEFAULT for missing messages.
+        The file is reloaded when it changes; an invalid file keeps the previous templates.
+    """
+    logger = logging.getLogger(__name__)
+
+    DEFAULT_LOCALE = "DEFAULT"
+    RELOAD_INTERVAL = 5.0
+    # Number of format arguments of each template, all others take none
+    ARGUMENTS = {
+        "YOU_CAN_LEAVE_NOW": 1,
+        "I_WILL_NOTIFY": 1,
+        "TRAFFIC_CONDITIONS": 2,
+        "SELECTION_OUT_OF_BOUNDS": 1,
+        "FORECAST_DEPARTURE": 1,
+    }
+
+    def __init__(self, path, locale=DEFAULT_LOCALE, arguments=ARGUMENTS, reload_interval=RELOAD_INTERVAL):
+        self.path = path
+        self.locale = locale
+        self.arguments = {name.lower(): count for name, count in arguments.items()}
+        self.reload_interval = reload_interval
+        self._templates = {}
+        self._mtime = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """
+            Parse and validate all templates of the file.
+        :raises MessageCatalogError: if the file can not be parsed or a template is invalid
+        """
+        mtime = os.path.getmtime(self.path)
+        parser = configparser.ConfigParser(interpolation=None)
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                parser.read_file(f)
+        except configparser.Error as e:
+            raise MessageCatalogError("Could not parse {}: {}".format(self.path, e))
+
+        templates = {}
+        errors = []
+        for locale in [self.DEFAULT_LOCALE] + parser.sections():
+            templates[locale] = {}
+            for name, value in parser.items(locale):
+                try:
+                    templates[locale][name] = self._compile(name, value)
+                except MessageCatalogError as e:
+                    errors.append("[{}] {}".format(locale, e))
+        if errors:
+            raise MessageCatalogError("Invalid messages in {}:\n{}".format(self.path, "\n".join(errors)))
+        with self._lock:
+            self._templates = templates
+            self._mtime = mtime
+            self._checked_at = time.time()
+
+    def _compile(self, name, value):
+        if not name.isidentifier():
+            raise MessageCatalogError("{} is not a valid message name".format(name))
+        try:
+            template = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            raise MessageCatalogError("{} is not a quoted string: {}".format(name.upper(), value))
+        if not isinstance(template, str):
+            raise MessageCatalogError("{} is not a string".format(name.upper()))
+        try:
+            fields = [field for _, field, _, _ in string.Formatter().parse(template) if field is not None]
+        except ValueError as e:
+            raise MessageCatalogError("{} is not a valid format string: {}".format(name.upper(), e))
+        expected = self.arguments.get(name, 0)
+        if len(fields) != expected or any(field not in ("", str(i)) for i, field in enumerate(fields)):
+            raise MessageCatalogError("{} needs {} positional placeholders, found {}".format(
+                name.upper(), expected, fields))
+        return template.format
+
+    def render(self, name, *args, locale=None):
+        self._reload_if_changed()
+        templates = self._templates
+        name = name.lower()
+        localized = templates.get(locale or self.locale)
+        if localized is not None and name in localized:
+            return localized[name](*args)
+        return templates[self.DEFAULT_LOCALE][name](*args)
+
+    def _reload_if_changed(self):
+        now = time.time()
+        if now - self._checked_at < self.reload_interval:
+            return
+        with self._lock:
+            if now - self._checked_at < self.reload_interval:
+                return
+            self._checked_at = now
+        try:
+            mtime = os.path.getmtime(self.path)
+            if mtime != self._mtime:
+                # Do not retry a broken file until it changes again
+                self._mtime = mtime
+                self.load()
+                self.logger.info("Reloaded messages from {}".format(self.path))
+        except (OSError, MessageCatalogError):
+            self.logger.exception("Could not reload messages. Keeping the previous ones.")
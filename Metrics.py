@@ -0,0 +1,350 @@
+import bisect
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+
+class Timer:
+    """
+        Context manager measuring one call. Exceptions and calls marked with fail()
+        are counted as errors of the endpoint.
+    """
+    __slots__ = ("metrics", "name", "labels", "start", "failed")
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.failed = False
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.name + "_seconds", time.perf_counter() - self.start, **self.labels)
+        if exc_type is not None or self.failed:
+            self.metrics.inc(self.name + "_errors_total", **self.labels)
+        return False
+
+    def fail(self):
+        self.failed = True
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "count", "sum")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+            Upper bound of the bucket containing the quantile q.
+        :return: seconds or None without observations
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    """
+        In-process registry of counters, latency histograms and gauges.
+        Recording is a dict lookup and an increment under one lock, cheap enough for
+        every upstream call. Gauges are callbacks evaluated only on export.
+    """
+    logger = logging.getLogger(__name__)
+
+    # Latency buckets in seconds
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._counters = Counter()
+        self._histograms = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] += value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def timer(self, name, **labels):
+        """
+            Measure a block: with metrics.timer("upstream", endpoint="google.geocode"): ...
+        """
+        return Timer(self, name, labels)
+
+    def gauge(self, name, function, **labels):
+        """
+            Register function, called without arguments on export, as current value of the gauge.
+        """
+        with self._lock:
+            self._gauges[self._key(name, labels)] = function
+
+    def counter_value(self, name, **labels):
+        with self._lock:
+            return self._counters[self._key(name, labels)]
+
+    def histogram(self, name, **labels):
+        with self._lock:
+            return self._histograms.get(self._key(name, labels))
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self._gauges.clear()
+
+    def _gauge_values(self):
+        with self._lock:
+            gauges = list(self._gauges.items())
+        values = []
+        for key, function in gauges:
+            try:
+                values.append((key, function()))
+            except Exception:
+                self.logger.exception("Could not evaluate gauge {}".format(key[0]))
+        return values
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels) + "}"
+
+    def render_prometheus(self):
+        """
+        :return: all metrics in the Prometheus text exposition format
+        """
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE {} {}".format(name, kind))
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(h.counts), h.count, h.sum)) for key, h in self._histograms.items())
+        for (name, labels), value in counters:
+            declare(name, "counter")
+            lines.append("{}{} {}".format(name, self._format_labels(labels), value))
+        for (name, labels), (counts, count, total) in histograms:
+            declare(name, "histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append("{}_bucket{} {}".format(name, self._format_labels(labels, [("le", bound)]), cumulative))
+            lines.append("{}_bucket{} {}".format(name, self._format_labels(labels, [("le", "+Inf")]), count))
+            lines.append("{}_sum{} {}".format(name, self._format_labels(labels), total))
+            lines.append("{}_count{} {}".format(name, self._format_labels(labels), count))
+        for (name, labels), value in sorted(self._gauge_values()):
+            declare(name, "gauge")
+            lines.append("{}{} {}".format(name, self._format_labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self):
+        """
+        :return: JSON serializable snapshot with p50/p99 estimates of the histograms
+        """
+        def label_key(name, labels):
+            return name + self._format_labels(labels)
+
+        with self._lock:
+            counters = {label_key(*key): value for key, value in self._counters.items()}
+            histograms = {label_key(*key): {"count": h.count, "sum": h.sum,
+                                            "p50": h.quantile(0.5), "p99": h.quantile(0.99)}
+                          for key, h in self._histograms.items()}
+        gauges = {label_key(*key): value for key, value in self._gauge_values()}
+        return {"timestamp": time.time(), "counters": counters, "histograms": histograms, "gauges": gauges}
+
+
+class SamplingProfiler:
+    """
+        Statistical profiler for a running bot. A background thread records the stacks
+        of all other threads every interval seconds via sys._current_frames. The result
+        is in the folded format of flamegraph.pl, one "frame;frame;frame count" per line.
+    """
+    logger = logging.getLogger(__name__)
+
+    INTERVAL = 0.01
+    MAX_DEPTH = 64
+
+    def __init__(self, interval=INTERVAL):
+        self.interval = interval
+        self.samples = Counter()
+        self._stopped = threading.Event()
+        self._worker = None
+
+    @property
+    def running(self):
+        return self._worker is not None
+
+    def start(self):
+        if self._worker is None:
+            self.samples.clear()
+            self._stopped.clear()
+            self._worker = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+            self._worker.start()
+            self.logger.info("Sampling profiler started")
+
+    def stop(self):
+        if self._worker is not None:
+            self._stopped.set()
+            self._worker.join()
+            self._worker = None
+            self.logger.info("Sampling profiler stopped after {} samples".format(sum(self.samples.values())))
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    self.samples[self._stack(frame)] += 1
+
+    def _stack(self, frame):
+        stack = []
+        while frame is not None and len(stack) < self.MAX_DEPTH:
+            code = frame.f_code
+            stack.append("{}:{}".format(os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        return ";".join(reversed(stack))
+
+    def folded(self):
+        return "".join("{} {}\n".format(stack, count) for stack, count in self.samples.most_common())
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    """
+        Local HTTP endpoint of the metrics and the profiler:
+        /metrics (Prometheus text), /metrics.json, /profile/start, /profile/stop and /profile (folded stacks).
+    """
+    daemon_threads = True
+
+    def __init__(self, metrics, profiler, port, host="127.0.0.1"):
+        super().__init__((host, port), MetricsRequestHandler)
+        self.metrics = metrics
+        self.profiler = profiler
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name=type(self).__name__, daemon=True)
+        thread.start()
+        return thread
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/metrics":
+            self._reply(self.server.metrics.render_prometheus(), "text/plain; version=0.0.4; charset=utf-8")
+        elif url.path == "/metrics.json":
+            self._reply(json.dumps(self.server.metrics.to_dict(), indent=2), "application/json; charset=utf-8")
+        elif url.path == "/profile/start":
+            interval = parse_qs(url.query).get("interval")
+            if interval:
+                self.server.profiler.interval = float(interval[0])
+            self.server.profiler.start()
+            self._reply("started\n")
+        elif url.path == "/profile/stop":
+            self.server.profiler.stop()
+            self._reply("stopped\n")
+        elif url.path == "/profile":
+            self._reply(self.server.profiler.folded())
+        else:
+            self.send_error(404)
+
+    def _reply(self, body, content_type="text/plain; charset=utf-8"):
+        body = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).debug(format, *args)
+
+
+class MetricsDumper:
+    """
+        Periodically writes the JSON snapshot of the metrics to a file, replacing it atomically.
+    """
+    logger = logging.getLogger(__name__)
+
+    INTERVAL = 60.0
+
+    def __init__(self, metrics, path, interval=INTERVAL):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._worker = None
+
+    def start(self):
+        if self._worker is None:
+            self._stopped.clear()
+            self._worker = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+            self._worker.start()
+
+    def stop(self):
+        if self._worker is not None:
+            self._stopped.set()
+            self._worker.join()
+            self._worker = None
+        self.dump()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.dump()
+            except Exception:
+                self.logger.exception("Could not dump metrics to {}".format(self.path))
+
+    def dump(self):
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            json.dump(self.metrics.to_dict(), f, indent=2)
+        os.replace(temporary_path, self.path)
+
+
+# Process wide registry shared by all instrumented modules
+metrics = Metrics()
+profiler = SamplingProfiler()
@@ -0,0 +1,202 @@
+import logging
+import threading
+import time
+
+from Metrics import metrics
+from RateLimiter import RateLimiter, RateLimitExceeded
+from RequestRegistry import RequestRegistry
+
+
+class PollingScheduler:
+    """
+        Polls the traffic situation for all running TravelRequests from a single worker thread.
+        Due requests are collected per tick and requests sharing their origin or destination
+        are checked with a single distance matrix call.
+    """
+    logger = logging.getLogger(__name__)
+
+    # Requests due within the same bucket are checked together
+    TICK = 1.0
+    # Limits of a single distance matrix call, see
+    # https://developers.google.com/maps/documentation/distance-matrix/usage-limits
+    MAX_ORIGINS = 25
+    MAX_DESTINATIONS = 25
+    # Delay before a request is retried after its travel time could not be checked
+    RETRY_DELAY = 30.0
+
+    def __init__(self, gmaps, callback, tick=TICK, registry=None, failure_callback=None, baseline_delay=None):
+        """
+        :param gmaps: GoogleWrapper used to query the distance matrix
+        :param callback: called with each TravelRequest after its travel time was updated
+        :param tick: granularity in seconds in which due requests are bucketed
+        :param registry: RequestRegistry holding the index of due checks
+        :param failure_callback: called with each TravelRequest whose travel time could not be checked,
+            by default the check is retried after RETRY_DELAY seconds
+        :param baseline_delay: fixed polling interval the number of checks is compared to
+        """
+        self.gmaps = gmaps
+        self.callback = callback
+        self.failure_callback = failure_callback or self.retry
+        self.tick = tick
+        self.registry = registry if registry is not None else RequestRegistry()
+        self.baseline_delay = baseline_delay
+        # Travel time checks sent to google, including failed ones
+        self.checks_made = 0
+        # Time between the successful checks of each request, which a fixed interval would have polled
+        self.watched_seconds = 0.0
+        self._started = time.time()
+        metrics.gauge("scheduled_checks", lambda: len(self))
+        metrics.gauge("checks_saved", lambda: self.checks_saved)
+        self._condition = threading.Condition()
+        self._running = False
+        self._worker = None
+
+    def start(self):
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+            self._started = time.time()
+        self._worker = threading.Thread(target=self._run, name="PollingScheduler", daemon=True)
+        self._worker.start()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if self._worker:
+            self._worker.join()
+            self._worker = None
+
+    def schedule(self, request, delay):
+        """
+            Check the travel time of request again in delay seconds.
+            An already scheduled check of the same request is replaced.
+        """
+        due = self._bucket(time.time() + delay)
+        with self._condition:
+            self.registry.set_due(request, due)
+            self._condition.notify()
+
+    @property
+    def checks_saved(self):
+        """
+            Checks polling every baseline_delay seconds would have made minus the checks actually made.
+        """
+        if not self.baseline_delay:
+            return 0.0
+        return self.watched_seconds / self.baseline_delay - self.checks_made
+
+    def _count_check(self, request, succeeded):
+        self.checks_made += 1
+        if succeeded and request.last_checked:
+            # Time before a restart was not watched
+            self.watched_seconds += time.time() - max(request.last_checked, self._started)
+
+    def retry(self, request):
+        self.schedule(request, self.RETRY_DELAY)
+
+    def cancel(self, request):
+        self.registry.clear_due(request)
+
+    def __len__(self):
+        return self.registry.due_count
+
+    def _bucket(self, timestamp):
+        return (int(timestamp / self.tick) + 1) * self.tick
+
+    def _run(self):
+        while True:
+            with self._condition:
+                due = self.registry.pop_due(time.time())
+                while self._running and not due:
+                    next_due = self.registry.next_due()
+                    self._condition.wait(next_due - time.time() if next_due is not None else None)
+                    due = self.registry.pop_due(time.time())
+                if not self._running:
+                    return
+            for batch in self.create_batches(due):
+                metrics.inc("travel_checks_total", len(batch))
+                with metrics.timer("poll_batch"):
+                    self._check_batch(batch)
+
+    @classmethod
+    def create_batches(cls, requests):
+        """
+            Group requests with the same origin, and the remaining ones with the same destination,
+            into batches of a single distance matrix call. Every batch has either one origin or
+            one destination, so the call only asks for pairs which were requested.
+        :return: list of lists of TravelRequests
+        """
+        by_origin = {}
+        for request in requests:
+            by_origin.setdefault(cls._key(request.origin), []).append(request)
+        batches = []
+        by_destination = {}
+        for group in by_origin.values():
+            if len({cls._key(request.destination) for request in group}) > 1:
+                batches.extend(cls._split(group, lambda request: cls._key(request.destination), cls.MAX_DESTINATIONS))
+            else:
+                for request in group:
+                    by_destination.setdefault(cls._key(request.destination), []).append(request)
+        for group in by_destination.values():
+            batches.extend(cls._split(group, lambda request: cls._key(request.origin), cls.MAX_ORIGINS))
+        return batches
+
+    @staticmethod
+    def _split(requests, key, limit):
+        """
+            Split requests into batches with at most limit distinct keys.
+        """
+        batches = []
+        indices = {}
+        for request in requests:
+            value = key(request)
+            if value not in indices:
+                if len(indices) % limit == 0:
+                    batches.append([])
+                indices[value] = len(batches) - 1
+            batches[indices[value]].append(request)
+        return batches
+
+    @staticmethod
+    def _key(location):
+        geocode = location["geocode"]
+        return geocode["lat"], geocode["lng"]
+
+    def _check_batch(self, requests):
+        origins = []
+        destinations = []
+        for request in requests:
+            if request.origin["geocode"] not in origins:
+                origins.append(request.origin["geocode"])
+            if request.destination["geocode"] not in destinations:
+                destinations.append(request.destination["geocode"])
+        try:
+            # Polling yields the quota to the conversations and is deferred if none is left
+            with RateLimiter.lane(RateLimiter.BACKGROUND):
+                matrix = self.gmaps.get_distance_matrices(origins, destinations)
+        except RateLimitExceeded as e:
+            self.logger.warning("Deferring {} requests: {}".format(len(requests), e))
+            matrix = None
+            checked = False
+        except Exception:
+            self.logger.exception("Could not check travel time for {} requests".format(len(requests)))
+            matrix = None
+            checked = True
+        else:
+            checked = True
+        for request in requests:
+            try:
+                result = None
+                if matrix is not None:
+                    result = matrix[origins.index(request.origin["geocode"])][destinations.index(request.destination["geocode"])]
+                if checked:
+                    self._count_check(request, result is not None)
+                if result is None:
+                    self.failure_callback(request)
+                    continue
+                request.update_travel(result)
+                self.callback(request)
+            except Exception:
+                self.logger.exception("Could not handle travel request {}".format(request.id))
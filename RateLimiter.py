@@ -0,0 +1,189 @@
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from Metrics import metrics
+
+
+class RateLimitExceeded(Exception):
+
+    def __init__(self, upstream):
+        super().__init__("No {} quota left for background calls".format(upstream))
+        self.upstream = upstream
+
+
+class TokenBucket:
+    """
+        Token bucket refilled with rate tokens per second up to capacity.
+        Interactive callers may take every token. Background callers leave reserve of
+        the capacity untouched and wait as long as an interactive caller is waiting,
+        so a burst of background work can not starve a user waiting for an answer.
+    """
+
+    def __init__(self, rate, capacity, reserve=0.25):
+        self.rate = rate
+        self.capacity = capacity
+        self.reserve = reserve * capacity
+        self.tokens = float(capacity)
+        self.waiting = {RateLimiter.INTERACTIVE: 0, RateLimiter.BACKGROUND: 0}
+        self._updated = time.monotonic()
+        self._condition = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _available(self, lane):
+        if lane == RateLimiter.INTERACTIVE:
+            return self.tokens
+        if self.waiting[RateLimiter.INTERACTIVE]:
+            return 0.0
+        return self.tokens - self.reserve
+
+    def acquire(self, lane, timeout=None):
+        """
+            Take one token, waiting until one is available for lane.
+        :return: False if no token could be taken within timeout seconds
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            self.waiting[lane] += 1
+            try:
+                while True:
+                    self._refill()
+                    available = self._available(lane)
+                    if available >= 1:
+                        self.tokens -= 1
+                        return True
+                    wait = (1 - available) / self.rate
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            return False
+                        wait = min(wait, remaining)
+                    self._condition.wait(wait)
+            finally:
+                self.waiting[lane] -= 1
+                # Background callers may proceed once no interactive caller waits anymore
+                self._condition.notify_all()
+
+
+class RateLimiter:
+    """
+        Shared limiter of the calls to Google Maps, Slack and Watson with one token bucket
+        per upstream. Every call runs in the lane of the calling thread, interactive unless
+        the thread entered RateLimiter.lane(RateLimiter.BACKGROUND) like the polling of running
+        watches does. Background calls are deferred by raising RateLimitExceeded once they
+        waited BACKGROUND_TIMEOUT seconds for a token.
+        Calls failing with 429, 5xx or a timeout are retried with jittered exponential backoff.
+        Calls which are not idempotent, like posting a message, are only retried on 429,
+        because after a server error they may have taken effect already.
+    """
+    logger = logging.getLogger(__name__)
+
+    INTERACTIVE = "interactive"
+    BACKGROUND = "background"
+
+    # Requests per second and burst capacity, overridden by RATE_LIMIT_<UPSTREAM> in requests per second
+    LIMITS = {
+        "google": (10.0, 20),
+        "slack": (20.0, 40),
+        "watson": (10.0, 20),
+    }
+    BACKGROUND_TIMEOUT = 10.0
+    MAX_RETRIES = 3
+    BACKOFF_BASE = 0.5
+    BACKOFF_MAX = 10.0
+    RETRY_STATUS = frozenset((429, 500, 502, 503, 504))
+    RATE_LIMIT_STATUS = frozenset((429,))
+
+    _local = threading.local()
+
+    def __init__(self, limits=None, background_timeout=BACKGROUND_TIMEOUT, max_retries=MAX_RETRIES):
+        self.background_timeout = background_timeout
+        self.max_retries = max_retries
+        self.buckets = {}
+        for upstream, (rate, capacity) in (limits or self.LIMITS).items():
+            bucket = self.buckets[upstream] = TokenBucket(rate, capacity)
+            for lane in (self.INTERACTIVE, self.BACKGROUND):
+                metrics.gauge("rate_limiter_waiting", lambda bucket=bucket, lane=lane: bucket.waiting[lane],
+                              upstream=upstream, lane=lane)
+            metrics.gauge("rate_limiter_tokens", lambda bucket=bucket: round(bucket.tokens, 2), upstream=upstream)
+
+    @classmethod
+    def from_environment(cls):
+        limits = {}
+        for upstream, (rate, capacity) in cls.LIMITS.items():
+            rate = float(os.environ.get('RATE_LIMIT_' + upstream.upper(), rate))
+            limits[upstream] = (rate, max(capacity, int(rate)))
+        return cls(limits)
+
+    @classmethod
+    @contextmanager
+    def lane(cls, lane):
+        """
+            Run the calls of the current thread within the block in lane.
+        """
+        previous = cls.current_lane()
+        cls._local.lane = lane
+        try:
+            yield
+        finally:
+            cls._local.lane = previous
+
+    @classmethod
+    def current_lane(cls):
+        return getattr(cls._local, "lane", cls.INTERACTIVE)
+
+    @classmethod
+    def is_retryable(cls, error, idempotent=True):
+        if getattr(error, "status", None) == "OVER_QUERY_LIMIT":
+            return True
+        # Timeouts of requests and googlemaps, matched by name so neither library has to be imported
+        if idempotent and any(base.__name__ == "Timeout" for base in type(error).__mro__):
+            return True
+        status = getattr(error, "status_code", None) or getattr(error, "code", None)
+        if status is None and getattr(error, "response", None) is not None:
+            status = getattr(error.response, "status_code", None)
+        return status in (cls.RETRY_STATUS if idempotent else cls.RATE_LIMIT_STATUS)
+
+    def backoff(self, attempt):
+        # Full jitter spreads the retries of concurrent callers
+        return random.uniform(0, min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** attempt))
+
+    def call(self, upstream, function, should_retry=None, idempotent=True):
+        """
+            Call function once a token of upstream is available and retry it on rate limit and server errors.
+        :param should_retry: optional predicate of a result which failed without an exception
+        :param idempotent: False if function must not be repeated after a server error
+        :return: result of function
+        """
+        bucket = self.buckets.get(upstream)
+        lane = self.current_lane()
+        attempt = 0
+        while True:
+            if bucket is not None:
+                start = time.monotonic()
+                timeout = self.background_timeout if lane == self.BACKGROUND else None
+                acquired = bucket.acquire(lane, timeout)
+                metrics.observe("rate_limiter_wait_seconds", time.monotonic() - start, upstream=upstream, lane=lane)
+                if not acquired:
+                    metrics.inc("rate_limiter_deferred_total", upstream=upstream)
+                    raise RateLimitExceeded(upstream)
+            try:
+                result = function()
+            except Exception as e:
+                if attempt >= self.max_retries or not self.is_retryable(e, idempotent):
+                    raise
+                self.logger.warning("Retrying {} call after {}".format(upstream, e))
+            else:
+                if attempt >= self.max_retries or should_retry is None or not should_retry(result):
+                    return result
+                self.logger.warning("Retrying {} call after response {}".format(upstream, result))
+            metrics.inc("upstream_retries_total", upstream=upstream)
+            time.sleep(self.backoff(attempt))
+            attempt += 1
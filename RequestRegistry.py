@@ -0,0 +1,159 @@
+import heapq
+import itertools
+import threading
+
+from Metrics import metrics
+from User import User
+
+
+class RequestRegistry:
+    """
+        Registry of all users with an ongoing conversation and their TravelRequests.
+        Besides the lookup by user id, users are indexed by their conversation context
+        and scheduled TravelRequests by the timestamp of their next check, so neither
+        finding due work nor removing a user needs a scan.
+        All changes are recorded in the optional StateStore.
+    """
+
+    def __init__(self, store=None):
+        self.store = store
+        self._users = {}
+        self._by_context = {}
+        # request id -> (due timestamp, sequence, request)
+        self._due = {}
+        # Heap of (due timestamp, sequence, request id), entries no longer in _due are skipped
+        self._due_queue = []
+        self._sequence = itertools.count()
+        self._lock = threading.RLock()
+
+    def add(self, user):
+        self.restore(user)
+        self._record(user)
+
+    def restore(self, user):
+        """
+            Add a user which was loaded from the StateStore without recording it again.
+        """
+        with self._lock:
+            self._remove(user.id)
+            self._users[user.id] = user
+            self._by_context.setdefault(user.context, set()).add(user.id)
+
+    def get(self, user_id):
+        return self._users.get(user_id)
+
+    def remove(self, user_id):
+        """
+            Remove a user together with the scheduled check of its TravelRequest.
+        :return: the removed user or None
+        """
+        user = self._remove(user_id)
+        if user is not None and self.store is not None:
+            self.store.remove(user_id)
+        return user
+
+    def _remove(self, user_id):
+        with self._lock:
+            user = self._users.pop(user_id, None)
+            if user is None:
+                return None
+            self._discard_context(user)
+            if user.travel_request is not None:
+                self.clear_due(user.travel_request)
+            return user
+
+    def set_context(self, user, context):
+        metrics.inc("context_transitions_total",
+                    from_context=User.CONTEXT_NAMES[user.context], to_context=User.CONTEXT_NAMES[context])
+        with self._lock:
+            if user.id in self._users:
+                self._discard_context(user)
+                self._by_context.setdefault(context, set()).add(user.id)
+            user.context = context
+        self._record(user)
+
+    def update(self, user):
+        """
+            Record a change of user besides its context, e.g. the locations to choose from.
+        """
+        self._record(user)
+
+    def users_in_context(self, context):
+        with self._lock:
+            return [self._users[user_id] for user_id in self._by_context.get(context, ())]
+
+    def count_in_context(self, context):
+        return len(self._by_context.get(context, ()))
+
+    def _record(self, user):
+        if self.store is not None and user.id in self._users:
+            self.store.record(user)
+
+    def _discard_context(self, user):
+        users = self._by_context.get(user.context)
+        if users is not None:
+            users.discard(user.id)
+            if not users:
+                del self._by_context[user.context]
+
+    def set_due(self, request, due):
+        """
+            Schedule the next check of request, replacing an earlier one.
+        """
+        with self._lock:
+            sequence = next(self._sequence)
+            request.next_check = due
+            self._due[request.id] = (due, sequence, request)
+            heapq.heappush(self._due_queue, (due, sequence, request.id))
+        if request.user is not None:
+            self._record(request.user)
+
+    def clear_due(self, request):
+        with self._lock:
+            request.next_check = None
+            self._due.pop(request.id, None)
+
+    def next_due(self):
+        """
+        :return: timestamp of the earliest scheduled check or None
+        """
+        with self._lock:
+            self._drop_stale()
+            return self._due_queue[0][0] if self._due_queue else None
+
+    def pop_due(self, now):
+        """
+            Remove and return all requests which are due at now.
+        """
+        due = []
+        with self._lock:
+            self._drop_stale()
+            while self._due_queue and self._due_queue[0][0] <= now:
+                _, _, request_id = heapq.heappop(self._due_queue)
+                _, _, request = self._due.pop(request_id)
+                request.next_check = None
+                due.append(request)
+                self._drop_stale()
+        return due
+
+    def _drop_stale(self):
+        while self._due_queue:
+            _, sequence, request_id = self._due_queue[0]
+            entry = self._due.get(request_id)
+            if entry is not None and entry[1] == sequence:
+                return
+            heapq.heappop(self._due_queue)
+
+    @property
+    def due_count(self):
+        return len(self._due)
+
+    def __contains__(self, user_id):
+        return user_id in self._users
+
+    def __len__(self):
+        return len(self._users)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._users.values()))
@@ -0,0 +1,348 @@
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import os
+import select
+import signal
+import threading
+import time
+from collections import defaultdict
+
+from AsyncRuntime import AsyncRuntime
+
+# Messages between the front process and the workers, tuples starting with their kind
+EVENTS = "events"          # (EVENTS, rtm events) front -> worker
+REBALANCE = "rebalance"    # (REBALANCE, generation, shards) front -> worker
+IMPORT = "import"          # (IMPORT, user states) front -> worker
+STOP = "stop"              # (STOP,) front -> worker
+EXPORTED = "exported"      # (EXPORTED, generation, shard, user states) worker -> front
+
+
+class HashRing:
+    """
+        Consistent hash ring mapping user ids to shards. Every shard owns REPLICAS points
+        on the ring, so adding or removing one of N shards only moves about 1/N of the users.
+    """
+
+    REPLICAS = 100
+
+    def __init__(self, nodes=(), replicas=REPLICAS):
+        self.replicas = replicas
+        self.nodes = set()
+        self._points = []
+        self._owners = {}
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(str(key).encode("utf-8")).digest()[:8], "big")
+
+    def add(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for i in range(self.replicas):
+            point = self._hash("{}#{}".format(node, i))
+            self._owners[point] = node
+            bisect.insort(self._points, point)
+
+    def remove(self, node):
+        self.nodes.discard(node)
+        self._owners = {point: owner for point, owner in self._owners.items() if owner != node}
+        self._points = sorted(self._owners)
+
+    def get(self, key):
+        """
+        :return: the node owning key or None if the ring is empty
+        """
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._owners[self._points[index]]
+
+
+def run_worker(shard, nodes, inbox, outbox, bot_factory=None):
+    """
+        Entry point of a worker process. Runs a TravelAdvisor for the users hashed to shard.
+    :param bot_factory: callable creating the bot from the shard index, TravelAdvisor by default
+    """
+    # Spawned processes do not run the __main__ block which configures logging
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if bot_factory is None:
+        from TravelAdvisor import TravelAdvisor
+        bot_factory = TravelAdvisor
+    bot = bot_factory(shard=shard)
+    ShardWorker(shard, bot, HashRing(nodes), inbox, outbox).run()
+
+
+class ShardWorker:
+    """
+        Worker side of the sharded mode. The events routed by the front process are handled
+        on an AsyncRuntime and the worker polls the requests of its own users only.
+        On a rebalance the users now owned by other shards are exported to the front process,
+        which hands them to their new owners.
+    """
+    logger = logging.getLogger(__name__)
+
+    # Longest wait for running commands to finish before exporting users
+    IDLE_TIMEOUT = 10.0
+
+    def __init__(self, shard, bot, ring, inbox, outbox, runtime=None):
+        self.shard = shard
+        self.bot = bot
+        self.ring = ring
+        self.inbox = inbox
+        self.outbox = outbox
+        self.runtime = runtime or AsyncRuntime(bot)
+
+    def run(self):
+        threading.Thread(target=self._read_inbox, name="ShardInbox", daemon=True).start()
+        # Users restored from the state file of a different shard layout
+        self.outbox.put((EXPORTED, None, self.shard, self.export_foreign_users()))
+        try:
+            self.runtime.run(read_slack=False)
+        finally:
+            self.bot.scheduler.stop()
+            if self.bot.store is not None:
+                self.bot.store.stop()
+
+    def _read_inbox(self):
+        while True:
+            message = self.inbox.get()
+            kind = message[0]
+            if kind == EVENTS:
+                self.runtime.loop.call_soon_threadsafe(self.runtime.dispatch, message[1])
+            elif kind == REBALANCE:
+                _, generation, nodes = message
+                self.ring = HashRing(nodes)
+                self._wait_idle()
+                self.outbox.put((EXPORTED, generation, self.shard, self.export_foreign_users()))
+            elif kind == IMPORT:
+                for state in message[1]:
+                    self.bot.import_user(state)
+                self.logger.info("Shard {} imported {} users".format(self.shard, len(message[1])))
+            elif kind == STOP:
+                self.runtime.stop()
+                return
+
+    def _wait_idle(self):
+        """
+            Wait until the events received so far are handled, so no user is exported mid-command.
+        """
+        dispatched = threading.Event()
+        self.runtime.loop.call_soon_threadsafe(dispatched.set)
+        dispatched.wait(self.IDLE_TIMEOUT)
+        deadline = time.time() + self.IDLE_TIMEOUT
+        while not self.runtime.idle and time.time() < deadline:
+            time.sleep(0.01)
+
+    def export_foreign_users(self):
+        states = []
+        for user in list(self.bot.registry):
+            if self.ring.get(user.id) != self.shard:
+                state = self.bot.export_user(user.id)
+                if state is not None:
+                    states.append(state)
+        if states:
+            self.logger.info("Shard {} exported {} users".format(self.shard, len(states)))
+        return states
+
+
+class ShardFront:
+    """
+        Front process of the sharded mode. It owns the slack connection and routes the
+        events of every user to the worker process owning the user on a consistent hash ring.
+        Workers exchange messages with the front through multiprocessing queues, so no broker is needed.
+        Workers are added with SIGTTIN and removed with SIGTTOU. While the users of a changed
+        ring move between workers, events of moving users are held back until their state arrived.
+        Crashed workers are restarted and restore their users from their own state file.
+        If reading from slack fails the websocket is reconnected, if that fails as well run returns.
+    """
+    logger = logging.getLogger(__name__)
+
+    # Only used if the websocket of the slack client can not be watched directly
+    READ_DELAY = 0.1
+    SUPERVISE_INTERVAL = 1.0
+    STOP_TIMEOUT = 10.0
+    # Events without a user which are broadcast to all workers
+    BROADCAST_EVENTS = ("user_change", "team_join")
+
+    def __init__(self, slack_client, shards, bot_factory=None, context=None):
+        self.slack_client = slack_client
+        self.bot_factory = bot_factory
+        self.context = context or multiprocessing.get_context("spawn")
+        self.ring = HashRing(range(shards))
+        self.workers = {}
+        self.outbox = self.context.Queue()
+        self._generation = 0
+        self._pending_exports = set()
+        self._previous_ring = None
+        self._buffered = []
+        self._leaving = set()
+        self._resize = 0
+        self._lock = threading.RLock()
+        for shard in range(shards):
+            self._spawn(shard)
+        threading.Thread(target=self._collect, name="ShardCollector", daemon=True).start()
+
+    def _spawn(self, shard):
+        inbox = self.context.Queue()
+        process = self.context.Process(target=run_worker, name="shard-{}".format(shard),
+                                       args=(shard, sorted(self.ring.nodes), inbox, self.outbox, self.bot_factory))
+        process.start()
+        self.workers[shard] = (process, inbox)
+        self.logger.info("Started shard {} as process {}".format(shard, process.pid))
+
+    def _send(self, shard, message):
+        self.workers[shard][1].put(message)
+
+    def dispatch(self, events):
+        """
+            Route RTM events to the workers, one message per worker and batch.
+        """
+        batches = defaultdict(list)
+        with self._lock:
+            for event in events or []:
+                user = event.get("user")
+                if isinstance(user, str):
+                    shard = self.ring.get(user)
+                    if self._previous_ring is not None and self._previous_ring.get(user) != shard:
+                        self._buffered.append(event)
+                    else:
+                        batches[shard].append(event)
+                elif event.get("type") in self.BROADCAST_EVENTS:
+                    for shard in self.workers:
+                        batches[shard].append(event)
+            for shard, batch in batches.items():
+                self._send(shard, (EVENTS, batch))
+
+    def add_worker(self):
+        with self._lock:
+            shard = 0
+            while shard in self.workers:
+                shard += 1
+            self._rebalance(self.ring.nodes | {shard})
+            self._spawn(shard)
+
+    def remove_worker(self, shard=None):
+        with self._lock:
+            active = self.ring.nodes - self._leaving
+            if len(active) <= 1:
+                self.logger.warning("Can not remove the last shard")
+                return
+            shard = max(active) if shard is None else shard
+            self._leaving.add(shard)
+            self._rebalance(self.ring.nodes - {shard})
+
+    def _rebalance(self, nodes):
+        if self._previous_ring is None:
+            self._previous_ring = self.ring
+        self.ring = HashRing(nodes)
+        self._generation += 1
+        self._pending_exports = set(self.workers)
+        for shard in self.workers:
+            self._send(shard, (REBALANCE, self._generation, sorted(nodes)))
+        self.logger.info("Rebalancing to shards {}".format(sorted(nodes)))
+
+    def _collect(self):
+        while True:
+            _, generation, shard, states = self.outbox.get()
+            with self._lock:
+                imports = defaultdict(list)
+                for state in states:
+                    imports[self.ring.get(state["id"])].append(state)
+                for target, target_states in imports.items():
+                    self._send(target, (IMPORT, target_states))
+                if generation == self._generation:
+                    self._pending_exports.discard(shard)
+                if shard in self._leaving and generation is not None and shard not in self.ring.nodes:
+                    self._send(shard, (STOP,))
+                self._finish_rebalance()
+
+    def _finish_rebalance(self):
+        if self._previous_ring is None or self._pending_exports:
+            return
+        self._previous_ring = None
+        buffered, self._buffered = self._buffered, []
+        self.dispatch(buffered)
+        self.logger.info("Rebalanced to shards {}".format(sorted(self.ring.nodes)))
+
+    def supervise(self):
+        with self._lock:
+            for shard, (process, _) in list(self.workers.items()):
+                if process.is_alive():
+                    continue
+                if shard in self._leaving:
+                    process.join()
+                    del self.workers[shard]
+                    self._leaving.discard(shard)
+                    self._pending_exports.discard(shard)
+                    self.logger.info("Stopped shard {}".format(shard))
+                else:
+                    self.logger.error("Shard {} exited with {}. Restarting it".format(shard, process.exitcode))
+                    self._pending_exports.discard(shard)
+                    self._spawn(shard)
+            self._finish_rebalance()
+            while self._resize > 0:
+                self._resize -= 1
+                self.add_worker()
+            while self._resize < 0:
+                self._resize += 1
+                self.remove_worker()
+
+    def _on_signal(self, signum, frame):
+        # Resizing takes the lock, so it is left to the main loop
+        self._resize += 1 if signum == signal.SIGTTIN else -1
+
+    def run(self):
+        signal.signal(signal.SIGTTIN, self._on_signal)
+        signal.signal(signal.SIGTTOU, self._on_signal)
+        supervised = time.time()
+        try:
+            while True:
+                self._wait_for_events(max(0.0, supervised + self.SUPERVISE_INTERVAL - time.time()))
+                try:
+                    events = self.slack_client.rtm_read()
+                except Exception:
+                    self.logger.exception("Could not read from slack")
+                    if not self.slack_client.rtm_connect(with_team_state=False, reconnect=True):
+                        self.logger.error("Could not reconnect to slack. Stopping")
+                        return
+                    self.logger.info("Reconnected to slack")
+                else:
+                    self.dispatch(events)
+                if time.time() - supervised > self.SUPERVISE_INTERVAL:
+                    self.supervise()
+                    supervised = time.time()
+        finally:
+            self.stop()
+
+    def _wait_for_events(self, timeout):
+        """
+            Block until the slack websocket is readable or timeout passed.
+        """
+        server = getattr(self.slack_client, "server", None)
+        sock = getattr(getattr(server, "websocket", None), "sock", None)
+        if sock is None:
+            time.sleep(min(timeout, self.READ_DELAY))
+            return
+        # Decrypted data buffered by SSL does not make the socket readable again
+        pending = getattr(sock, "pending", None)
+        if pending is not None and pending():
+            return
+        try:
+            select.select([sock], [], [], timeout)
+        except (OSError, ValueError):
+            # The socket was closed, rtm_read reports it
+            pass
+
+    def stop(self):
+        with self._lock:
+            for shard in self.workers:
+                self._send(shard, (STOP,))
+            for process, _ in self.workers.values():
+                process.join(self.STOP_TIMEOUT)
+            self.workers.clear()
@@ -0,0 +1,165 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+
+class StateStore:
+    """
+        Base class of the persistence backends for the conversation state of users.
+        Changes are only collected by record and remove. They are written in batches
+        by a background thread every flush_interval seconds, so several transitions of
+        the same user between two flushes cost a single write.
+    """
+    logger = logging.getLogger(__name__)
+
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._worker = None
+
+    def record(self, user):
+        state = user.to_dict()
+        with self._lock:
+            self._pending[user.id] = state
+
+    def remove(self, user_id):
+        with self._lock:
+            self._pending[user_id] = None
+
+    def start(self):
+        if self._worker is None:
+            self._stopped.clear()
+            self._worker = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+            self._worker.start()
+
+    def stop(self):
+        if self._worker is not None:
+            self._stopped.set()
+            self._worker.join()
+            self._worker = None
+        self.flush()
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                self.logger.exception("Could not persist state")
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                changes = self._pending
+                self._pending = {}
+            if changes:
+                self._write(changes)
+
+    def _write(self, changes):
+        """
+            Durably store changes, a dict of user id to state dict or None for removed users.
+        """
+        raise NotImplementedError
+
+    def load(self):
+        """
+        :return: list of the state dicts of all stored users
+        """
+        raise NotImplementedError
+
+
+class JournalStateStore(StateStore):
+    """
+        Append-only journal with one JSON line per change. The latest line of a user wins.
+        The journal is compacted on load and whenever it grew much larger than the
+        number of stored users, which keeps the time to replay it bounded.
+    """
+
+    COMPACT_MIN_LINES = 1000
+    COMPACT_FACTOR = 4
+
+    def __init__(self, path, flush_interval=StateStore.FLUSH_INTERVAL):
+        super().__init__(flush_interval)
+        self.path = path
+        self._lines = 0
+        self._users = set()
+
+    def _write(self, changes):
+        with open(self.path, "a", encoding="utf-8") as f:
+            for user_id, state in changes.items():
+                f.write(json.dumps({"id": user_id, "state": state}) + "\n")
+                if state is None:
+                    self._users.discard(user_id)
+                else:
+                    self._users.add(user_id)
+            f.flush()
+            os.fsync(f.fileno())
+        self._lines += len(changes)
+        if self._lines > max(self.COMPACT_MIN_LINES, self.COMPACT_FACTOR * len(self._users)):
+            self._compact(self._replay())
+
+    def load(self):
+        with self._flush_lock:
+            states = self._replay()
+            self._compact(states)
+            return list(states.values())
+
+    def _replay(self):
+        states = {}
+        if not os.path.isfile(self.path):
+            return states
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A crash may leave the last line incomplete
+                    self.logger.warning("Skipping corrupt journal line in {}".format(self.path))
+                    continue
+                if entry["state"] is None:
+                    states.pop(entry["id"], None)
+                else:
+                    states[entry["id"]] = entry["state"]
+        return states
+
+    def _compact(self, states):
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            for user_id, state in states.items():
+                f.write(json.dumps({"id": user_id, "state": state}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.path)
+        self._lines = len(states)
+        self._users = set(states)
+
+
+class SQLiteStateStore(StateStore):
+    """
+        Stores the state of every user as a JSON row of a SQLite database.
+    """
+
+    def __init__(self, path, flush_interval=StateStore.FLUSH_INTERVAL):
+        super().__init__(flush_interval)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA synchronous = FULL")
+        with self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS users (id TEXT PRIMARY KEY, state TEXT)")
+
+    def _write(self, changes):
+        with self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO users VALUES (?, ?)",
+                                         [(user_id, json.dumps(state)) for user_id, state in changes.items()
+                                          if state is not None])
+            self._connection.executemany("DELETE FROM users WHERE id = ?",
+                                         [(user_id,) for user_id, state in changes.items() if state is None])
+
+    def load(self):
+        with self._flush_lock:
+            return [json.loads(row[0]) for row in self._connection.execute("SELECT state FROM users")]
@@ -1,17 +1,38 @@
+import time
+# Taken before the other imports, so the reported startup time includes loading the modules
+IMPORT_STARTED = time.time()
+
 import configparser
+import atexit
 import os
-import time
-import threading
+import random
 import json
+import signal
 import sys
 import logging
+import threading
+from functools import partial
 
 from slackclient import SlackClient
-from watson_developer_cloud import ConversationV1
 
+from AsyncRuntime import AsyncRuntime
+from BotIdentity import BotIdentity
+from EventQueue import EventQueue
 from GoogleWrapper import GoogleWrapper
+from HttpTransport import HttpTransport
+from IntentClassifier import IntentClassifier
+from MessageCatalog import MessageCatalog
+from Metrics import MetricsDumper, MetricsServer, metrics, profiler
+from PollingScheduler import PollingScheduler
+from RateLimiter import RateLimiter
+from RequestRegistry import RequestRegistry
+from Sharding import ShardFront
+from StateStore import JournalStateStore, SQLiteStateStore
 from TravelRequest import TravelRequest
 from User import User
+from UserDirectory import UserDirectory
+
+IMPORT_FINISHED = time.time()
 
 class TravelAdvisor:
     logger = logging.getLogger(__name__)
@@ -21,26 +42,73 @@ class TravelAdvisor:
     INTENTS_CONFIG_FILE = "intents.conf"
     USES_WATSON = True
 
-    CHECK_TRAVEL_DELAY = 60.0*2
-    MAX_TRAVEL_CHECKS = 3600/CHECK_TRAVEL_DELAY
+    STATE_FILE = "state.sqlite"
+    JOURNAL_FILE = "state.journal"
 
-    def __init__(self):
-        if not os.environ.get('SLACK_BOT_TOKEN'):
-            sys.exit("No environment variable \"SLACK_BOT_TOKEN\" found.")
-        self.slack_client = SlackClient(os.environ.get('SLACK_BOT_TOKEN'))
+    # Polling interval without adaptive delays, used as baseline for the saved checks
+    CHECK_TRAVEL_DELAY = 60.0*2
+    MIN_CHECK_TRAVEL_DELAY = 60.0
+    MAX_CHECK_TRAVEL_DELAY = 60.0*15
+    MAX_TRAVEL_TIME = 3600.0
+    # Departure times predicted up front: every FORECAST_STEP seconds for FORECAST_SLOTS slots
+    FORECAST_MODE = True
+    FORECAST_STEP = 60.0*10
+    FORECAST_SLOTS = 12
+    # Live checks of a forecast departure start this many seconds before it
+    FORECAST_LEAD = 60.0*5
+    # Slack errors worth another attempt. Only a rate limited message is known to be not posted,
+    # after any other error a retry could post it twice
+    SLACK_RETRY_ERRORS = ("ratelimited",)
+    # Overdue checks of restored requests are spread over this many seconds
+    RECOVERY_SPREAD = 30.0
+    PROFILE_FILE = "profile.folded"
+    # Seconds from loading this module until the bot is ready, exceeding it is logged as warning
+    STARTUP_BUDGET = 2.0
+
+    def __init__(self, slack_client=None, gmaps=None, conversation=None, shard=None):
+        """
+            The clients are created from the environment unless they are passed in,
+            e.g. by the load test.
+        :param shard: index of the worker process in sharded mode, which gets its own state file and metrics port
+        """
+        self.shard = shard
+        self._startup_phases = [("imports", IMPORT_FINISHED - IMPORT_STARTED)]
+        self._phase_started = time.time()
+        # Injected Google wrappers bring their limiter and transport along so all upstreams share them
+        self.limiter = gmaps.limiter if gmaps is not None else RateLimiter.from_environment()
+        self.transport = gmaps.transport if gmaps is not None else HttpTransport.from_environment()
+        if slack_client is None:
+            if not os.environ.get('SLACK_BOT_TOKEN'):
+                sys.exit("No environment variable \"SLACK_BOT_TOKEN\" found.")
+            slack_client = SlackClient(os.environ.get('SLACK_BOT_TOKEN'))
+            self.transport.attach_slack(slack_client.server.api_requester)
+        self.slack_client = slack_client
         if not self.slack_client:
             sys.exit("Could not instantiate slack client. Wrong Token?")
+        self.user_directory = UserDirectory(self.slack_client)
+        self._startup_phase("slack")
 
         self.BOT_ID = self._get_bot_id()
         self.AT_BOT = "<@" + self.BOT_ID + ">"
-
-        if not os.environ.get('GOOGLE_MAPS_API_TOKEN'):
-            sys.exit("No environment variable \"GOOGLE_MAPS_API_TOKEN\" found.")
-        self.gmaps = GoogleWrapper(os.environ.get('GOOGLE_MAPS_API_TOKEN'))
+        self._startup_phase("bot identity")
+
+        if gmaps is None:
+            if not os.environ.get('GOOGLE_MAPS_API_TOKEN'):
+                sys.exit("No environment variable \"GOOGLE_MAPS_API_TOKEN\" found.")
+            # googlemaps is imported on the first query
+            gmaps = GoogleWrapper(os.environ.get('GOOGLE_MAPS_API_TOKEN'), limiter=self.limiter,
+                                  transport=self.transport)
+        self.gmaps = gmaps
         if not self.gmaps:
             sys.exit("Could not instantiate Google Maps client. Wrong Token?")
+        self.FORECAST_MODE = os.environ.get('FORECAST_MODE', '1') != '0'
 
-        if not os.getenv('VCAP_SERVICES'):
+        # Watson is imported on the first message the intent classifier can not answer itself
+        self._conversation = conversation
+        self._conversation_lock = threading.Lock()
+        if conversation is not None:
+            self.WATSON_WORKSPACE_ID = os.environ.get('WATSON_WORKSPACE_ID')
+        elif not os.getenv('VCAP_SERVICES'):
             self.logger.warning("No VCAP_SERVICES found. Running without Bluemix Services.")
             self.USES_WATSON = False
             self.logger.warning("USES_WATSON is {}".format(self.USES_WATSON))
@@ -49,65 +117,213 @@ class TravelAdvisor:
             self.WATSON_USER = vcap_services['conversation'][0]['credentials']['username']
             self.WATSON_PASSWORD = vcap_services['conversation'][0]['credentials']['password']
             self.WATSON_WORKSPACE_ID = os.environ.get('WATSON_WORKSPACE_ID')
-            self.conversation = ConversationV1(
-                username=self.WATSON_USER,
-                password=self.WATSON_PASSWORD,
-                version= self.WATSON_CONVERSATION_VERSION
-            )
-
-        self.users = {}
-        self.messages = self._load_config(self.MESSAGES_CONFIG_FILE)
+        self._startup_phase("google and watson")
+
+        self.messages = MessageCatalog(self._config_path(self.MESSAGES_CONFIG_FILE),
+                                       locale=os.environ.get('MESSAGES_LOCALE', MessageCatalog.DEFAULT_LOCALE))
         self.intents = self._load_config(self.INTENTS_CONFIG_FILE)
+        self.intent_classifier = IntentClassifier(self.intents, self.get_watson_intent)
+        self._startup_phase("config")
+
+        self.store = self._create_state_store()
+        self.registry = RequestRegistry(self.store)
+        self.scheduler = PollingScheduler(self.gmaps, self.check_travel_request, registry=self.registry,
+                                          failure_callback=self.travel_check_failed,
+                                          baseline_delay=self.CHECK_TRAVEL_DELAY)
+        self.restore_state()
+        self._startup_phase("state")
+        self.scheduler.start()
+        self._start_metrics()
+        self._startup_phase("scheduler and metrics")
+        self._report_startup()
+
+    @property
+    def conversation(self):
+        """
+            Watson conversation client, created on first use.
+        :return: None if running without Watson
+        """
+        if self._conversation is None and self.USES_WATSON:
+            with self._conversation_lock:
+                if self._conversation is None:
+                    from watson_developer_cloud import ConversationV1
+                    conversation = ConversationV1(
+                        username=self.WATSON_USER,
+                        password=self.WATSON_PASSWORD,
+                        version=self.WATSON_CONVERSATION_VERSION
+                    )
+                    self.transport.attach_timeouts(conversation)
+                    self._conversation = conversation
+        return self._conversation
+
+    def _startup_phase(self, name):
+        now = time.time()
+        self._startup_phases.append((name, now - self._phase_started))
+        self._phase_started = now
+
+    def _report_startup(self):
+        """
+            Log the time spent in each startup phase against STARTUP_BUDGET.
+        """
+        self.startup_seconds = sum(seconds for _, seconds in self._startup_phases)
+        metrics.gauge("startup_seconds", lambda: round(self.startup_seconds, 3))
+        budget = float(os.environ.get('STARTUP_BUDGET', self.STARTUP_BUDGET))
+        phases = ", ".join("{} {:.0f}ms".format(name, seconds * 1000) for name, seconds in self._startup_phases)
+        message = "Started in {:.0f}ms of {:.0f}ms budget: {}".format(self.startup_seconds * 1000, budget * 1000, phases)
+        if self.startup_seconds > budget:
+            self.logger.warning(message)
+        else:
+            self.logger.info(message)
 
     def _get_bot_id(self):
         """
             Identify the user ID assigned to the bot so we can identify messages.
+            Uses the cached auth.test answer and only falls back to the member list if slack
+            does not answer auth.test.
         :return: The user id of the bot example: U79Q3RS22
         """
-        api_call = self.slack_client.api_call("users.list")
-        if api_call.get('ok'):
-            # retrieve all users so we can find our bot
-            users = api_call.get('members')
-            for user in users:
-                if 'name' in user and user.get('name') == self.BOT_NAME:
-                    return user.get('id')
+        identity = BotIdentity(getattr(self.slack_client, 'token', None) or os.environ.get('SLACK_BOT_TOKEN'),
+                               os.environ.get('BOT_IDENTITY_FILE', BotIdentity.FILE))
+        return identity.resolve(self.slack_client) or self.user_directory.get_id(self.BOT_NAME)
+
+    def _create_state_store(self):
+        backend = os.environ.get('STATE_STORE', 'sqlite')
+        if backend == 'sqlite':
+            store = SQLiteStateStore(self._shard_path(os.environ.get('STATE_FILE', self._config_path(self.STATE_FILE))))
+        elif backend == 'journal':
+            store = JournalStateStore(self._shard_path(os.environ.get('STATE_FILE', self._config_path(self.JOURNAL_FILE))))
+        elif backend == 'none':
+            return None
+        else:
+            sys.exit("Unknown STATE_STORE \"{}\". Use sqlite, journal or none.".format(backend))
+        store.start()
+        atexit.register(store.stop)
+        return store
+
+    def _shard_path(self, path):
+        if self.shard is None:
+            return path
+        root, extension = os.path.splitext(path)
+        return "{}-{}{}".format(root, self.shard, extension)
+
+    def _start_metrics(self):
+        """
+            Register the gauges of the bot and start the exports configured by
+            METRICS_PORT (Prometheus text on /metrics) and METRICS_FILE (periodic JSON dump).
+        """
+        metrics.gauge("active_watches", lambda: self.registry.count_in_context(User.CONTEXT_REQUEST_RUNNING))
+        metrics.gauge("users", lambda: len(self.registry))
+        metrics.gauge("threads", threading.active_count)
+        metrics.gauge("watson_calls_avoided", lambda: self.intent_classifier.avoided_calls)
+        if os.environ.get('METRICS_PORT'):
+            port = int(os.environ['METRICS_PORT'])
+            if self.shard is not None:
+                # The front process keeps METRICS_PORT, worker i serves on the port i + 1 above
+                port += self.shard + 1
+            server = MetricsServer(metrics, profiler, port, os.environ.get('METRICS_HOST', '127.0.0.1'))
+            server.start()
+            self.logger.info("Serving metrics on port {}".format(server.server_port))
+        if os.environ.get('METRICS_FILE'):
+            dumper = MetricsDumper(metrics, self._shard_path(os.environ['METRICS_FILE']),
+                                   float(os.environ.get('METRICS_INTERVAL', MetricsDumper.INTERVAL)))
+            dumper.start()
+            atexit.register(dumper.stop)
+        if os.environ.get('PROFILER') == '1':
+            profiler.start()
+
+    def toggle_profiler(self, signum=None, frame=None):
+        """
+            Start the sampling profiler or stop it and write the folded stacks to PROFILE_FILE.
+            Installed as handler of SIGUSR1, so it can be switched on in a running bot.
+        """
+        if not profiler.running:
+            profiler.start()
+            return
+        profiler.stop()
+        path = os.environ.get('PROFILE_FILE', self._config_path(self.PROFILE_FILE))
+        with open(path, "w") as f:
+            f.write(profiler.folded())
+        self.logger.info("Wrote profile to {}".format(path))
 
-    def _load_config(self, configFile):
+    def restore_state(self):
+        """
+            Reload the users of the last run and resume polling their running requests.
+        """
+        if self.store is None:
+            return
+        start = time.time()
+        running = 0
+        for state in self.store.load():
+            user = self.import_user(state, record=False)
+            if user.context == User.CONTEXT_REQUEST_RUNNING:
+                running += 1
+        self.logger.info("Restored {} users with {} running requests in {:.2f}s".format(
+            len(self.registry), running, time.time() - start))
+
+    def import_user(self, state, record=True):
+        """
+            Add a user from its state dict and resume polling its running request.
+        :param record: False if the user is already in the StateStore
+        """
+        user = User.from_dict(state)
+        if record:
+            self.registry.add(user)
+        else:
+            self.registry.restore(user)
+        if user.context == User.CONTEXT_REQUEST_RUNNING and user.travel_request:
+            request = user.travel_request
+            now = time.time()
+            if request.next_check and request.next_check > now:
+                delay = request.next_check - now
+            else:
+                delay = random.uniform(0, self.RECOVERY_SPREAD)
+            self.scheduler.schedule(request, delay)
+        return user
+
+    def export_user(self, user_id):
+        """
+            Remove a user handed over to another shard.
+        :return: the state dict of the user or None
+        """
+        user = self.registry.get(user_id)
+        if user is None:
+            return None
+        state = user.to_dict()
+        self.registry.remove(user_id)
+        if user.travel_request:
+            # A check already in progress must not reschedule the request
+            user.travel_request.user = None
+        return state
+
+    def _config_path(self, configFile):
         parent_dir = os.path.dirname(__file__)
-        config_file = os.path.join(parent_dir, configFile)
+        return os.path.join(parent_dir, configFile)
+
+    def _load_config(self, configFile):
         parser = configparser.ConfigParser()
-        parser.read(config_file)
+        parser.read(self._config_path(configFile))
         return parser
 
     def get_user_name(self, user_id):
-        api_call = self.slack_client.api_call("users.list")
-        if api_call.get('ok'):
-            # retrieve all users so we can find our bot
-            users = api_call.get('members')
-            for user in users:
-                if 'id' in user and user.get('id') == user_id:
-                    return user.get('name')
+        return self.user_directory.get_name(user_id)
 
     def parse_slack_output(self,slack_rtm_output):
         """
             The Slack Real Time Messaging API is an events firehose.
-            this parsing function returns None unless a message is
-            directed at the Bot, based on its ID.
+            this parsing function yields a tuple (command, channel, user, is_AT_bot)
+            for every message in slack_rtm_output which is directed at the Bot,
+            based on its ID.
         """
-        output_list = slack_rtm_output
-        if output_list and len(output_list) > 0:
-            for output in output_list:
-                if output and 'text' in output and self.AT_BOT in output['text']:
-                    # return text after the @ mention, whitespace removed
-                    return output['text'].split(self.AT_BOT)[1].strip().lower(), \
-                           output['channel'], output['user'], True
-                else:
-                    if output and 'channel' in output and not isinstance(output['channel'],dict) and output['channel'].startswith("D") \
-                    and 'type' in output and output['type'] == 'message' \
-                    and 'user' in output and output['user'] != self.BOT_ID:
-                        return output['text'], output['channel'], output['user'], False
-
-        return None, None, None, None
+        for output in slack_rtm_output or []:
+            self.user_directory.handle_event(output)
+            if output and 'text' in output and self.AT_BOT in output['text']:
+                # return text after the @ mention, whitespace removed
+                yield output['text'].split(self.AT_BOT)[1].strip().lower(), \
+                      output['channel'], output['user'], True
+            elif output and 'channel' in output and not isinstance(output['channel'],dict) and output['channel'].startswith("D") \
+            and 'type' in output and output['type'] == 'message' \
+            and 'user' in output and output['user'] != self.BOT_ID:
+                yield output['text'], output['channel'], output['user'], False
 
     def handle_command(self,command, user_id, channel, is_AT_bot):
         """
@@ -115,112 +331,129 @@ class TravelAdvisor:
             are valid commands. If so, then acts on the commands. If not,
             returns back what it needs for clarification.
         """
+        user = self.registry.get(user_id)
+        context = user.context if user else User.CONTEXT_NONE
+        with metrics.timer("command", context=User.CONTEXT_NAMES[context]):
+            self._handle_command(command, user_id, channel, is_AT_bot)
+
+    def _handle_command(self, command, user_id, channel, is_AT_bot):
         if is_AT_bot:
-            intent = self.get_watson_intent(command)
+            intent = self.get_intent(command)
             if intent == self.intents.get("DEFAULT","SAY_HELLO"):
                 self.logger.info("say hello intent detected")
-                self.send_message(eval(self.messages.get("DEFAULT","SAY_HELLO")), channel)
+                self.send_message(self.messages.render("SAY_HELLO"), channel)
         else:
-            intent = self.get_watson_intent(command)
+            intent = self.get_intent(command)
             if intent == self.intents.get("DEFAULT","WHEN_SHOULD_I_LEAVE"):
-                if user_id in self.users:
-                    user = self.users.get(user_id)
+                if user_id in self.registry:
+                    user = self.registry.get(user_id)
                     if user.context == User.CONTEXT_REQUEST_RUNNING:
                         self.already_existing_request(user, channel)
                 else:
                     new_user = User(user_id)
-                    self.users[user_id] = new_user
                     new_user.name = self.get_user_name(user_id)
                     new_user.add_travel_request(TravelRequest(channel))
                     new_user.context = User.CONTEXT_REQUEST_STARTED
+                    self.registry.add(new_user)
                     self.ask_for_origin(channel)
             elif intent == self.intents.get("DEFAULT","CANCEL_REQUEST"):
-                if user_id in self.users:
-                    user = self.users.get(user_id)
-                    user.travel_request.user = None
+                user = self.registry.remove(user_id)
+                if user:
+                    if user.travel_request:
+                        user.travel_request.user = None
                     user.travel_request = None
                     user.context = User.CONTEXT_NONE
-                    self.users.pop(user_id)
-                    response = eval(self.messages.get("DEFAULT", "REQUEST_CANCELLED"))
+                    response = self.messages.render("REQUEST_CANCELLED")
                     self.send_message(response, channel)
                 else:
-                    response = eval(self.messages.get("DEFAULT", "UNKOWN_USER"))
+                    response = self.messages.render("UNKOWN_USER")
                     self.send_message(response, channel)
-            elif user_id in self.users:
-                user = self.users.get(user_id)
+            elif user_id in self.registry:
+                user = self.registry.get(user_id)
                 if user.context == User.CONTEXT_REQUEST_STARTED:
-                    user.context = User.CONTEXT_ORIGIN_SUPPLIED
+                    self.registry.set_context(user, User.CONTEXT_ORIGIN_SUPPLIED)
                     self.handle_origin_supplied(user, command, channel)
                 elif user.context == User.CONTEXT_ORIGIN_SUPPLIED:
-                    if self.is_number(command):
-                        if int(command) > 0 and len(user.origins) >= int(command)-1:
+                    if not user.origins:
+                        # The locations to choose from were lost, e.g. by a restart before they were stored
+                        self.registry.set_context(user, User.CONTEXT_REQUEST_STARTED)
+                        self.send_message(self.messages.render("ORIGIN"), channel)
+                    elif self.is_number(command):
+                        if 0 < int(command) <= len(user.origins):
                             user.travel_request.origin = user.origins[int(command)-1]
-                            user.context = User.CONTEXT_ORIGIN_SELECTED
+                            user.origins = None
+                            self.registry.set_context(user, User.CONTEXT_ORIGIN_SELECTED)
                             self.ask_for_destination(channel)
                         else:
-                            response = eval(self.messages.get("DEFAULT", "SELECTION_OUT_OF_BOUNDS"))
-                            response.format(len(user.origins)-1)
+                            response = self.messages.render("SELECTION_OUT_OF_BOUNDS", len(user.origins))
                             self.send_message(response, channel)
                     else:
-                        response = eval(self.messages.get("DEFAULT", "SELECTION_OUT_OF_BOUNDS"))
-                        response.format(len(user.origins) - 1)
+                        response = self.messages.render("SELECTION_OUT_OF_BOUNDS", len(user.origins))
                         self.send_message(response, channel)
                 elif user.context == User.CONTEXT_ORIGIN_SELECTED:
-                    user.context = User.CONTEXT_DESTINATION_SUPPLIED
+                    self.registry.set_context(user, User.CONTEXT_DESTINATION_SUPPLIED)
                     self.handle_destination_supplied(user, command, channel)
                 elif user.context == User.CONTEXT_DESTINATION_SUPPLIED:
-                    if self.is_number(command):
-                        if int(command) > 0 and len(user.destinations) >= int(command) - 1:
+                    if not user.destinations:
+                        self.registry.set_context(user, User.CONTEXT_ORIGIN_SELECTED)
+                        self.ask_for_destination(channel)
+                    elif self.is_number(command):
+                        if 0 < int(command) <= len(user.destinations):
                             user.travel_request.destination = user.destinations[int(command)-1]
-                            user.context = User.CONTEXT_DESTINATION_SELECTED
-                            user.travel_request.check_current_travel(self.gmaps)
-                            self.ask_for_target_duration(user, channel)
+                            user.destinations = None
+                            self.registry.set_context(user, User.CONTEXT_DESTINATION_SELECTED)
+                            self.handle_destination_selected(user, channel)
                         else:
-                            response = eval(self.messages.get("DEFAULT", "SELECTION_OUT_OF_BOUNDS"))
-                            response.format(len(user.destinations)-1)
+                            response = self.messages.render("SELECTION_OUT_OF_BOUNDS", len(user.destinations))
                             self.send_message(response, channel)
                     else:
-                        response = eval(self.messages.get("DEFAULT", "SELECTION_OUT_OF_BOUNDS"))
-                        response.format(len(user.destinations) - 1)
+                        response = self.messages.render("SELECTION_OUT_OF_BOUNDS", len(user.destinations))
                         self.send_message(response, channel)
                 elif user.context == User.CONTEXT_DESTINATION_SELECTED:
                     user.travel_request.target_duration = int(command) * 60
-                    user.context = User.CONTEXT_REQUEST_RUNNING
+                    self.registry.set_context(user, User.CONTEXT_REQUEST_RUNNING)
                     self.handle_travel_request(user.travel_request, channel)
                 else:
-                    self.send_message(eval(self.messages.get("DEFAULT", "UNKOWN_COMMAND")), channel)
+                    self.send_message(self.messages.render("UNKOWN_COMMAND"), channel)
             else:
-                self.send_message(eval(self.messages.get("DEFAULT","UNKOWN_COMMAND")), channel)
+                self.send_message(self.messages.render("UNKOWN_COMMAND"), channel)
 
     def handle_destination_supplied(self, user, destination_supplied, channel):
         locations = self.gmaps.get_geocode_for_location(destination_supplied)
         if locations and len(locations) == 1:
             user.travel_request.destination = locations[0]
-            user.context = User.CONTEXT_DESTINATION_SELECTED
-            user.travel_request.check_current_travel(self.gmaps)
-            self.ask_for_target_duration(user, channel)
+            self.registry.set_context(user, User.CONTEXT_DESTINATION_SELECTED)
+            self.handle_destination_selected(user, channel)
         elif locations and len(locations) > 1:
             user.destinations = locations
+            self.registry.update(user)
             self.ask_to_choose_location(locations, channel)
         else:
-            user.context = User.CONTEXT_REQUEST_STARTED
+            self.registry.set_context(user, User.CONTEXT_REQUEST_STARTED)
             self.no_location_found(channel)
 
+    def handle_destination_selected(self, user, channel):
+        if user.travel_request.check_current_travel(self.gmaps):
+            self.ask_for_target_duration(user, channel)
+        else:
+            self.no_route_found(user, channel)
+
     def handle_origin_supplied(self, user, origin_supplied, channel):
         locations = self.gmaps.get_geocode_for_location(origin_supplied)
         if locations and len(locations) == 1:
             user.travel_request.origin = locations[0]
-            user.context = User.CONTEXT_ORIGIN_SELECTED
+            self.registry.set_context(user, User.CONTEXT_ORIGIN_SELECTED)
             self.ask_for_destination(channel)
         elif locations and len(locations) > 1:
             user.origins = locations
+            self.registry.update(user)
             self.ask_to_choose_location(locations, channel)
         else:
-            user.context = User.CONTEXT_REQUEST_STARTED
+            self.registry.set_context(user, User.CONTEXT_REQUEST_STARTED)
             self.no_location_found(channel)
 
     def ask_to_choose_location(self, locations, channel):
-        response = eval(self.messages.get("DEFAULT", "CHOOSE_LOCATION"))
+        response = self.messages.render("CHOOSE_LOCATION")
         response += "\n "
         i = 1
         for location in locations:
@@ -229,71 +462,153 @@ class TravelAdvisor:
         self.send_message(response, channel)
 
     def no_location_found(self, channel):
-        response = eval(self.messages.get("DEFAULT", "NO_LOCATION_FOUND"))
+        response = self.messages.render("NO_LOCATION_FOUND")
+        self.send_message(response, channel)
+
+    def no_route_found(self, user, channel):
+        """
+            Start the request over, the user may have picked the wrong location.
+        """
+        user.travel_request.user = None
+        user.add_travel_request(TravelRequest(channel))
+        self.registry.set_context(user, User.CONTEXT_REQUEST_STARTED)
+        response = "{} {}".format(self.messages.render("NO_ROUTE_FOUND"), self.messages.render("ORIGIN"))
         self.send_message(response, channel)
 
     def ask_for_target_duration(self, user, channel):
-        response = eval(self.messages.get("DEFAULT","TRAFFIC_CONDITIONS")).format(user.travel_request.duration_in_traffic["text"], user.travel_request.duration["text"])
+        response = self.messages.render("TRAFFIC_CONDITIONS", user.travel_request.duration_in_traffic["text"], user.travel_request.duration["text"])
         self.send_message(response, channel)
-        response = eval(self.messages.get("DEFAULT","TARGET_DURATION"))
+        response = self.messages.render("TARGET_DURATION")
         self.send_message(response, channel)
 
     def ask_for_destination(self, channel):
-        response = eval(self.messages.get("DEFAULT","DESTINATION"))
+        response = self.messages.render("DESTINATION")
         self.send_message(response, channel)
 
     def ask_for_origin(self,channel):
-        response = "{} {}".format(eval(self.messages.get("DEFAULT","DETECTED_WHEN_SHOULD_I_LEAVE")), eval(self.messages.get("DEFAULT","ORIGIN")))
+        response = "{} {}".format(self.messages.render("DETECTED_WHEN_SHOULD_I_LEAVE"), self.messages.render("ORIGIN"))
         self.send_message(response, channel)
 
     def already_existing_request(self, user, channel):
-        response = "{} {} {}".format(eval(self.messages.get("DEFAULT","EXISTING_REQUEST")), eval(self.messages.get("DEFAULT","CURRENT_TRAVEL_TIME")),user.travel_request.duration_in_traffic['text'])
+        response = "{} {} {}".format(self.messages.render("EXISTING_REQUEST"), self.messages.render("CURRENT_TRAVEL_TIME"),user.travel_request.duration_in_traffic['text'])
         self.send_message(response, channel)
 
     def handle_travel_request(self, request, channel):
-        request.check_current_travel(self.gmaps)
+        request.started = time.time()
+        if not request.check_current_travel(self.gmaps):
+            self.no_route_found(request.user, channel)
+            return
 
-        message = "{}{}".format(eval(self.messages.get("DEFAULT","CURRENT_TRAVEL_TIME")),request.duration_in_traffic['text'])
+        message = "{}{}".format(self.messages.render("CURRENT_TRAVEL_TIME"),request.duration_in_traffic['text'])
         self.send_message(message,channel)
 
-        message = eval(self.messages.get("DEFAULT","I_WILL_NOTIFY")).format(int(request.target_duration/60))
+        message = self.messages.render("I_WILL_NOTIFY", int(request.target_duration/60))
         self.send_message(message, channel)
 
+        if self.FORECAST_MODE and request.duration_in_traffic['value'] > request.target_duration:
+            self.forecast_travel_request(request, channel)
         self.check_travel_request(request)
 
+    def forecast_travel_request(self, request, channel):
+        """
+            Predict the earliest departure meeting the target from the traffic forecast and tell the user.
+        """
+        now = time.time()
+        departure_times = [int(now + self.FORECAST_STEP * i) for i in range(1, self.FORECAST_SLOTS + 1)]
+        try:
+            departure = request.forecast(self.gmaps, departure_times)
+        except Exception:
+            self.logger.exception("Could not forecast request {}. Polling live traffic only.".format(request.id))
+            return
+        if departure:
+            message = self.messages.render("FORECAST_DEPARTURE", self._format_time(departure))
+            self.send_message(message, channel)
+
+    def _format_time(self, timestamp):
+        # Slack shows the time in the timezone of the reader
+        return "<!date^{}^{{time}}|{} UTC>".format(int(timestamp), time.strftime("%H:%M", time.gmtime(timestamp)))
+
+    def _watch_deadline(self, request):
+        start = request.started
+        if request.forecast_departure:
+            start = max(start, request.forecast_departure - self.FORECAST_LEAD)
+        return start + self.MAX_TRAVEL_TIME
+
 
     def check_travel_request(self, request):
-        #Only check MAX_TRAVEL_CHECK times to prevent endless checks
-        if request.counter > self.MAX_TRAVEL_CHECKS:
-            request.user.travel_request = None
-            request.user.context = User.CONTEXT_NONE
-            self.users.pop(request.user.id)
-            request.user = None
-            message = eval(self.messages.get("DEFAULT", "TIME_EXCEEDED"))
-            self.send_message(message, channel)
+        """
+            Evaluates the latest travel time of request and either notifies the user
+            or schedules the next check with the polling scheduler.
+        """
+        if request.user is None:
+            # Request was cancelled in the meantime
             return
+        if request.duration_in_traffic['value'] <= request.target_duration:
+            message = self.messages.render("YOU_CAN_LEAVE_NOW", request.destination["address"])
+            self.send_message(message, request.channel)
+            self.registry.remove(request.user.id)
+        #Only check for MAX_TRAVEL_TIME to prevent endless checks
+        elif time.time() > self._watch_deadline(request):
+            self._expire_travel_request(request)
         else:
-            request.check_current_travel(self.gmaps)
-            if request.duration_in_traffic['value'] <= request.target_duration:
-                message = "{} nach {}".format(eval(self.messages.get("DEFAULT","YOU_CAN_LEAVE_NOW")),request.destination["address"])
-                self.send_message(message, request.channel)
-                self.users.pop(request.user.id)
+            now = time.time()
+            if request.forecast_departure and now < request.forecast_departure - self.FORECAST_LEAD:
+                # Confirm the forecast with live traffic shortly before the departure
+                delay = request.forecast_departure - self.FORECAST_LEAD - now
             else:
-                timer = threading.Timer(self.CHECK_TRAVEL_DELAY, self.check_travel_request, args=(request,))
-                timer.start()
+                delay = min(request.next_check_delay(self.MIN_CHECK_TRAVEL_DELAY, self.MAX_CHECK_TRAVEL_DELAY),
+                            self._watch_deadline(request) - now)
+            self.scheduler.schedule(request, delay)
+            self.logger.debug("Next check of request {} in {:.0f}s. Saved {:.1f} checks with {} made so far".format(
+                request.id, delay, self.scheduler.checks_saved, self.scheduler.checks_made))
+
+    def travel_check_failed(self, request):
+        """
+            Retry a request whose travel time could not be checked until its watch deadline passed.
+        """
+        if request.user is None:
+            return
+        if time.time() > self._watch_deadline(request):
+            self._expire_travel_request(request)
+        else:
+            self.scheduler.retry(request)
+
+    def _expire_travel_request(self, request):
+        self.registry.remove(request.user.id)
+        request.user.travel_request = None
+        request.user.context = User.CONTEXT_NONE
+        request.user = None
+        message = self.messages.render("TIME_EXCEEDED")
+        self.send_message(message, request.channel)
 
     def send_message(self, message, channel):
-        self.slack_client.api_call("chat.postMessage", channel=channel, text=message, as_user=True)
+        with metrics.timer("upstream", endpoint="slack.chat.postMessage") as timer:
+            response = self.limiter.call("slack", partial(self.slack_client.api_call, "chat.postMessage",
+                                                          channel=channel, text=message, as_user=True),
+                                         self._slack_should_retry, idempotent=False)
+            if not response or not response.get('ok'):
+                timer.fail()
+
+    def _slack_should_retry(self, response):
+        return bool(response) and not response.get('ok') and response.get('error') in self.SLACK_RETRY_ERRORS
 
     def get_watson_response(self, text):
         if not self.USES_WATSON:
             return None
         else:
-            response_from_watson = self.conversation.message(workspace_id=self.WATSON_WORKSPACE_ID,
-                                                         input={'text': text},
-                                                         context={})
+            with metrics.timer("upstream", endpoint="watson.message"):
+                response_from_watson = self.limiter.call("watson", partial(self.conversation.message,
+                                                                           workspace_id=self.WATSON_WORKSPACE_ID,
+                                                                           input={'text': text},
+                                                                           context={}))
             return response_from_watson
 
+    def get_intent(self, text):
+        intent = self.intent_classifier.classify(text)
+        self.logger.debug("Intent classifier avoided {} Watson calls, saving {:.1f}s".format(
+            self.intent_classifier.avoided_calls, self.intent_classifier.saved_time))
+        return intent
+
     def get_watson_intent(self, text):
         response = self.get_watson_response(text)
         if response and 'intents' in response and len(response['intents']) > 0:
@@ -312,6 +627,9 @@ class TravelAdvisor:
 
 
 if __name__ == "__main__":
+    # Before anything logs, otherwise the startup report and the metrics port are not shown
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
     # Log version (git commit hash)
     parent_dir = os.path.dirname(__file__)
     version_file = os.path.join(parent_dir, 'VERSION')
@@ -324,15 +642,38 @@ if __name__ == "__main__":
     else:
         print("Could not find VERSION file")
 
+    shards = int(os.environ.get('SHARDS', '1'))
+    if shards > 1:
+        # This process only routes the events, the users live in the worker processes
+        if not os.environ.get('SLACK_BOT_TOKEN'):
+            sys.exit("No environment variable \"SLACK_BOT_TOKEN\" found.")
+        slack_client = SlackClient(os.environ.get('SLACK_BOT_TOKEN'))
+        if not slack_client.rtm_connect():
+            sys.exit("Connection failed. Invalid Slack token or bot ID?")
+        print("Routing events to {} shards".format(shards))
+        ShardFront(slack_client, shards).run()
+        sys.exit("Lost connection to slack")
+
     bot = TravelAdvisor()
+    signal.signal(signal.SIGUSR1, bot.toggle_profiler)
 
     READ_WEBSOCKET_DELAY = 0.1  # 1 second delay between reading from firehose
     if bot.slack_client.rtm_connect():
-        print("StarterBot connected and running!")
-        while True:
-            command, channel, user, is_AT_bot = bot.parse_slack_output(bot.slack_client.rtm_read())
-            if command and channel and user:
-                bot.handle_command(command, user, channel, is_AT_bot)
-            time.sleep(READ_WEBSOCKET_DELAY)
+        print("StarterBot connected and running after {:.0f}ms".format((time.time() - IMPORT_STARTED) * 1000))
+        if os.environ.get('RUNTIME', 'asyncio') == 'asyncio':
+            AsyncRuntime(bot).run()
+        else:
+            # Legacy mode handling one command after another
+            queue = EventQueue()
+            while True:
+                for event in bot.parse_slack_output(bot.slack_client.rtm_read()):
+                    queue.put(event[2], event)
+                item = queue.get()
+                while item:
+                    user, (command, channel, _, is_AT_bot) = item
+                    bot.handle_command(command, user, channel, is_AT_bot)
+                    queue.task_done(user)
+                    item = queue.get()
+                time.sleep(READ_WEBSOCKET_DELAY)
     else:
         print("Connection failed. Invalid Slack token or bot ID?")
@@ -1,11 +1,27 @@
-import uuid
-from datetime import datetime
+import itertools
+import struct
+import time
+from collections import deque
 
 class TravelRequest:
 
+    # Coordinates are kept as two packed doubles instead of a dict of floats
+    COORDINATES = struct.Struct("dd")
+    _ids = itertools.count(1)
+    # Number of past travel times used to estimate the traffic trend
+    SAMPLE_COUNT = 5
+    # Assumed fastest rate at which the travel time can drop, in seconds per second
+    MAX_IMPROVEMENT_RATE = 0.5
+
+    __slots__ = ("id", "started", "last_checked", "next_check", "_origin", "_destination", "target_duration",
+                 "channel", "distance", "duration", "duration_in_traffic", "counter", "samples", "forecast_departure",
+                 "user")
+
     def __init__(self, channel, origin = None, destination= None, target_duration=None):
-        self.id = uuid.uuid4()
+        self.id = next(self._ids)
+        self.started = None
         self.last_checked = None
+        self.next_check = None
         self.origin = origin
         self.destination = destination
         self.target_duration = target_duration
@@ -14,14 +30,132 @@ class TravelRequest:
         self.duration = None
         self.duration_in_traffic = None
         self.counter = 0
+        self.samples = deque(maxlen=self.SAMPLE_COUNT)
+        self.forecast_departure = None
         self.user = None
 
+    @classmethod
+    def _pack(cls, location):
+        if location is None:
+            return None
+        return location["address"], cls.COORDINATES.pack(location["geocode"]["lat"], location["geocode"]["lng"])
+
+    @classmethod
+    def _unpack(cls, packed):
+        if packed is None:
+            return None
+        lat, lng = cls.COORDINATES.unpack(packed[1])
+        return {"address": packed[0], "geocode": {"lat": lat, "lng": lng}}
+
+    @property
+    def origin(self):
+        return self._unpack(self._origin)
+
+    @origin.setter
+    def origin(self, location):
+        self._origin = self._pack(location)
+
+    @property
+    def destination(self):
+        return self._unpack(self._destination)
+
+    @destination.setter
+    def destination(self, location):
+        self._destination = self._pack(location)
+
+    def to_dict(self):
+        return {
+            "started": self.started,
+            "channel": self.channel,
+            "origin": self.origin,
+            "destination": self.destination,
+            "target_duration": self.target_duration,
+            "distance": self.distance,
+            "duration": self.duration,
+            "duration_in_traffic": self.duration_in_traffic,
+            "counter": self.counter,
+            "last_checked": self.last_checked,
+            "next_check": self.next_check,
+            "samples": list(self.samples),
+            "forecast_departure": self.forecast_departure,
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        request = cls(state["channel"], state["origin"], state["destination"], state["target_duration"])
+        request.distance = state["distance"]
+        request.duration = state["duration"]
+        request.duration_in_traffic = state["duration_in_traffic"]
+        request.counter = state["counter"]
+        request.last_checked = state["last_checked"]
+        request.next_check = state["next_check"]
+        request.started = state.get("started", state["last_checked"])
+        request.samples.extend(tuple(sample) for sample in state.get("samples", []))
+        request.forecast_departure = state.get("forecast_departure")
+        return request
+
     def check_current_travel(self, gmaps):
-        self.last_checked = datetime.now()
-        self.counter += 1
+        """
+        :return: False if there is no route between origin and destination
+        """
         matrix = gmaps.get_distance_matrix(self.origin["geocode"], self.destination["geocode"])
+        if matrix is None:
+            return False
+        self.update_travel(matrix)
+        return True
+
+    def update_travel(self, matrix):
+        self.last_checked = time.time()
+        self.counter += 1
         self.distance = matrix['distance']
         self.duration = matrix['duration']
         self.duration_in_traffic = matrix['duration_in_traffic']
+        self.samples.append((self.last_checked, self.duration_in_traffic['value']))
         if not self.target_duration:
             self.target_duration = self.duration['value']
+
+    def forecast(self, gmaps, departure_times):
+        """
+            Find the earliest of departure_times at which the predicted travel time meets the target.
+        :param departure_times: unix timestamps in ascending order
+        :return: the departure time or None if no departure time meets the target
+        """
+        results = gmaps.get_departure_forecast(self.origin["geocode"], self.destination["geocode"], departure_times)
+        self.forecast_departure = None
+        for departure_time, result in zip(departure_times, results):
+            if result is not None and result['duration_in_traffic']['value'] <= self.target_duration:
+                self.forecast_departure = departure_time
+                break
+        return self.forecast_departure
+
+    def trend(self):
+        """
+            Change of the travel time in seconds per second over the recorded samples,
+            negative while the traffic gets better.
+        :return: the slope of a least squares fit or None with fewer than two samples
+        """
+        if len(self.samples) < 2:
+            return None
+        mean_time = sum(sample[0] for sample in self.samples) / len(self.samples)
+        mean_duration = sum(sample[1] for sample in self.samples) / len(self.samples)
+        variance = sum((sample[0] - mean_time) ** 2 for sample in self.samples)
+        if not variance:
+            return None
+        covariance = sum((sample[0] - mean_time) * (sample[1] - mean_duration) for sample in self.samples)
+        return covariance / variance
+
+    def next_check_delay(self, min_delay, max_delay):
+        """
+            Seconds until the travel time should be checked again.
+            The further the travel time is above the target the longer the delay. If the
+            traffic is improving the delay is at most half the time until the trend reaches
+            the target.
+        """
+        gap = self.duration_in_traffic['value'] - self.target_duration
+        if gap <= 0:
+            return min_delay
+        delay = gap / self.MAX_IMPROVEMENT_RATE
+        trend = self.trend()
+        if trend is not None and trend < 0:
+            delay = min(delay, gap / -trend / 2)
+        return max(min_delay, min(max_delay, delay))
@@ -1,3 +1,5 @@
+from TravelRequest import TravelRequest
+
 class User:
 
     CONTEXT_NONE = 0
@@ -7,7 +9,11 @@ class User:
     CONTEXT_DESTINATION_SUPPLIED = 4
     CONTEXT_DESTINATION_SELECTED = 5
     CONTEXT_REQUEST_RUNNING = 6
+    # Labels of the contexts in the metrics
+    CONTEXT_NAMES = ("none", "request_started", "origin_supplied", "origin_selected",
+                     "destination_supplied", "destination_selected", "request_running")
 
+    __slots__ = ("id", "name", "travel_request", "context", "origins", "destinations")
 
     def __init__(self, id, name=None):
         self.id = id
@@ -20,3 +26,23 @@ class User:
     def add_travel_request(self, request):
         self.travel_request = request
         request.user = self
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "context": self.context,
+            "origins": self.origins,
+            "destinations": self.destinations,
+            "travel_request": self.travel_request.to_dict() if self.travel_request else None,
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        user = cls(state["id"], state["name"])
+        user.context = state["context"]
+        user.origins = state["origins"]
+        user.destinations = state["destinations"]
+        if state["travel_request"]:
+            user.add_travel_request(TravelRequest.from_dict(state["travel_request"]))
+        return user
@@ -0,0 +1,129 @@
+import logging
+import threading
+import time
+
+from Metrics import metrics
+
+
+class UserDirectory:
+    """
+        Index of the slack workspace members by id and by name.
+        The member list is downloaded once and afterwards kept up to date from
+        user_change and team_join RTM events. It is reloaded completely once the TTL
+        expired and single unknown users are looked up with users.info.
+        Callers arriving during the first download wait for it, a failed download is
+        retried after RETRY_DELAY.
+    """
+    logger = logging.getLogger(__name__)
+
+    TTL = 60.0 * 60 * 6
+    RETRY_DELAY = 60.0
+    PAGE_SIZE = 200
+
+    def __init__(self, slack_client, ttl=TTL):
+        self.slack_client = slack_client
+        self.ttl = ttl
+        self._names = {}
+        self._ids = {}
+        self._loaded_at = None
+        self._failed_at = None
+        self._lock = threading.RLock()
+        # Held while downloading the member list, so only one caller downloads it
+        self._load_lock = threading.Lock()
+
+    def load(self):
+        """
+            Download all members of the workspace, one page after another.
+        """
+        names = {}
+        ids = {}
+        cursor = None
+        while True:
+            kwargs = {"limit": self.PAGE_SIZE}
+            if cursor:
+                kwargs["cursor"] = cursor
+            with metrics.timer("upstream", endpoint="slack.users.list") as timer:
+                api_call = self.slack_client.api_call("users.list", **kwargs)
+                if not api_call.get('ok'):
+                    timer.fail()
+            if not api_call.get('ok'):
+                self.logger.error("Could not load slack users: {}".format(api_call.get('error')))
+                with self._lock:
+                    self._failed_at = time.time()
+                return False
+            for member in api_call.get('members', []):
+                if 'id' in member and 'name' in member:
+                    names[member['id']] = member['name']
+                    ids[member['name']] = member['id']
+            cursor = api_call.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                break
+        with self._lock:
+            self._names = names
+            self._ids = ids
+            self._loaded_at = time.time()
+            self._failed_at = None
+        self.logger.info("Loaded {} slack users".format(len(names)))
+        return True
+
+    def get_name(self, user_id):
+        self._refresh_if_expired()
+        with self._lock:
+            name = self._names.get(user_id)
+        if name is None:
+            name = self._fetch_user(user_id)
+        return name
+
+    def get_id(self, name):
+        self._refresh_if_expired()
+        with self._lock:
+            return self._ids.get(name)
+
+    def handle_event(self, event):
+        """
+            Update the directory from RTM events about new or changed members.
+        """
+        if event and event.get('type') in ('user_change', 'team_join') and isinstance(event.get('user'), dict):
+            self._add(event['user'])
+
+    def __len__(self):
+        return len(self._names)
+
+    def _expired(self):
+        now = time.time()
+        with self._lock:
+            if self._failed_at is not None and self._failed_at + self.RETRY_DELAY > now:
+                return False
+            return self._loaded_at is None or self._loaded_at + self.ttl <= now
+
+    def _refresh_if_expired(self):
+        if not self._expired():
+            return
+        # Without any members yet callers wait for the download, afterwards they use the old ones meanwhile
+        if not self._load_lock.acquire(blocking=self._loaded_at is None):
+            return
+        try:
+            # Callers which waited find the members loaded by the first one
+            if self._expired():
+                self.load()
+        finally:
+            self._load_lock.release()
+
+    def _fetch_user(self, user_id):
+        with metrics.timer("upstream", endpoint="slack.users.info") as timer:
+            api_call = self.slack_client.api_call("users.info", user=user_id)
+            if not api_call.get('ok'):
+                timer.fail()
+        if api_call.get('ok') and api_call.get('user'):
+            self._add(api_call['user'])
+            return api_call['user'].get('name')
+
+    def _add(self, member):
+        if 'id' not in member or 'name' not in member:
+            return
+        with self._lock:
+            old_name = self._names.get(member['id'])
+            if old_name is not None and self._ids.get(old_name) == member['id']:
+                del self._ids[old_name]
+            self._names[member['id']] = member['name']
+            self._ids[member['name']] = member['id']
@@ -0,0 +1,157 @@
+import hashlib
+import random
+import threading
+import time
+from collections import Counter, deque
+
+
+class FakeUpstreamError(Exception):
+
+    def __init__(self, endpoint, status_code=503):
+        super().__init__("Simulated error of {} with status {}".format(endpoint, status_code))
+        self.endpoint = endpoint
+        self.status_code = status_code
+
+
+class FakeUpstream:
+    """
+        Base of the local stand-ins for Slack, Google Maps and Watson.
+        Every call sleeps for a latency drawn around the configured mean, fails with the
+        configured error rate and is counted per endpoint.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self.errors = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _call(self, endpoint):
+        with self._lock:
+            self.calls[endpoint] += 1
+            failed = self._random.random() < self.error_rate
+            latency = self._random.uniform(0.5, 1.5) * self.latency
+            if failed:
+                self.errors[endpoint] += 1
+        if latency:
+            time.sleep(latency)
+        if failed:
+            raise FakeUpstreamError(endpoint)
+
+    @property
+    def total_calls(self):
+        return sum(self.calls.values())
+
+
+class FakeSlackClient(FakeUpstream):
+    """
+        SlackClient stand-in. Events passed to inject are returned by the next rtm_read and
+        every chat.postMessage is handed to the on_message callback.
+    """
+
+    BOT_ID = "UBOT"
+    BOT_NAME = "travel-advisor"
+
+    def __init__(self, user_ids=(), on_message=None, latency=0.0, error_rate=0.0, seed=None):
+        super().__init__(latency, error_rate, seed)
+        self.members = [{"id": self.BOT_ID, "name": self.BOT_NAME}]
+        self.members.extend({"id": user_id, "name": "user-" + user_id} for user_id in user_ids)
+        self.on_message = on_message
+        # No websocket, the asyncio runtime falls back to polling rtm_read
+        self.server = None
+        self._events = deque()
+
+    def api_call(self, method, **kwargs):
+        try:
+            self._call(method)
+        except FakeUpstreamError:
+            return {"ok": False, "error": "service_unavailable"}
+        if method == "users.list":
+            return {"ok": True, "members": self.members, "response_metadata": {"next_cursor": ""}}
+        if method == "users.info":
+            return {"ok": True, "user": {"id": kwargs["user"], "name": "user-" + kwargs["user"]}}
+        if method == "auth.test":
+            return {"ok": True, "user_id": self.BOT_ID, "user": self.BOT_NAME}
+        if method == "chat.postMessage":
+            if self.on_message:
+                self.on_message(kwargs["channel"], kwargs["text"])
+            return {"ok": True, "channel": kwargs["channel"], "ts": "{:.6f}".format(time.time())}
+        return {"ok": False, "error": "unknown_method"}
+
+    def rtm_connect(self, **kwargs):
+        return True
+
+    def rtm_read(self):
+        events = []
+        while self._events:
+            events.append(self._events.popleft())
+        return events
+
+    def inject(self, event):
+        self._events.append(event)
+
+
+class FakeGoogleMapsClient(FakeUpstream):
+    """
+        googlemaps.Client stand-in. Locations get stable coordinates derived from their name.
+        Traffic starts congested_factor times slower than the free flow and clears linearly
+        within clear_after seconds, so running watches eventually reach their target.
+    """
+
+    def __init__(self, congested_factor=2.0, clear_after=60.0, latency=0.0, error_rate=0.0, seed=None):
+        super().__init__(latency, error_rate, seed)
+        self.congested_factor = congested_factor
+        self.clear_after = clear_after
+        self.started = time.time()
+
+    def geocode(self, address):
+        self._call("geocode")
+        digest = hashlib.md5(address.lower().encode("utf-8")).digest()
+        lat = 49.0 + digest[0] / 255.0
+        lng = 8.0 + digest[1] / 255.0
+        return [{"formatted_address": address.title(), "geometry": {"location": {"lat": lat, "lng": lng}}}]
+
+    def places(self, query):
+        self._call("places")
+        return {"results": []}
+
+    def distance_matrix(self, origins, destinations, departure_time=None, **kwargs):
+        self._call("distance_matrix")
+        if isinstance(departure_time, (int, float)):
+            elapsed = departure_time - self.started
+        else:
+            elapsed = time.time() - self.started
+        factor = 1.0 + (self.congested_factor - 1.0) * max(0.0, 1.0 - elapsed / self.clear_after)
+        rows = []
+        for origin in origins:
+            elements = []
+            for destination in destinations:
+                duration = 600 + int((abs(origin["lat"] - destination["lat"]) + abs(origin["lng"] - destination["lng"])) * 600)
+                elements.append({
+                    "distance": {"value": duration * 15, "text": "{} km".format(duration * 15 // 1000)},
+                    "duration": {"value": duration, "text": "{} Minuten".format(duration // 60)},
+                    "duration_in_traffic": {"value": int(duration * factor), "text": "{} Minuten".format(int(duration * factor) // 60)},
+                })
+            rows.append({"elements": elements})
+        return {"rows": rows}
+
+
+class FakeConversation(FakeUpstream):
+    """
+        Watson ConversationV1 stand-in recognizing the intents by keywords.
+    """
+
+    KEYWORDS = (
+        ("losfahren", "when_should_I_leave"),
+        ("leave", "when_should_I_leave"),
+        ("hallo", "say_hello"),
+        ("abbrechen", "cancel_request"),
+    )
+
+    def message(self, workspace_id=None, input=None, context=None):
+        self._call("message")
+        text = input["text"].lower()
+        intents = [{"intent": intent, "confidence": 1.0} for keyword, intent in self.KEYWORDS if keyword in text]
+        return {"intents": intents[:1], "input": input, "context": context or {}}
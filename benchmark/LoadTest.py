@@ -0,0 +1,249 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import threading
+import time
+
+from AsyncRuntime import AsyncRuntime
+from GeocodeCache import GeocodeCache
+from GoogleWrapper import GoogleWrapper
+from TravelAdvisor import TravelAdvisor
+from benchmark.FakeClients import FakeConversation, FakeGoogleMapsClient, FakeSlackClient
+
+
+class LoadTest:
+    """
+        Drives simulated users through the whole conversation and watch lifecycle of a
+        TravelAdvisor running on the AsyncRuntime, with local stand-ins for Slack, Google Maps
+        and Watson. Alternatively replays recorded RTM events from a JSON lines file with one
+        event per line as the RTM API delivers it, see benchmark/events.jsonl.
+        All delays of the bot are multiplied by time_scale so watches finish within seconds.
+    """
+    logger = logging.getLogger(__name__)
+
+    PLACES = ("Mainz", "Wiesbaden", "Frankfurt", "Darmstadt", "Bingen", "Ingelheim")
+    # Delays of TravelAdvisor which are scaled for the load test
+    SCALED_DELAYS = ("CHECK_TRAVEL_DELAY", "MIN_CHECK_TRAVEL_DELAY", "MAX_CHECK_TRAVEL_DELAY", "MAX_TRAVEL_TIME",
+                     "FORECAST_STEP", "FORECAST_LEAD", "RECOVERY_SPREAD")
+    MONITOR_INTERVAL = 0.05
+
+    def __init__(self, users=10, latency=0.05, error_rate=0.0, target_minutes=35, clear_after=20.0,
+                 time_scale=0.01, workers=AsyncRuntime.MAX_WORKERS, timeout=120.0, seed=None):
+        self.user_count = users
+        self.latency = latency
+        self.error_rate = error_rate
+        self.target_minutes = target_minutes
+        self.clear_after = clear_after
+        self.time_scale = time_scale
+        self.workers = workers
+        self.timeout = timeout
+        self.random = random.Random(seed)
+        self.seed = seed
+
+        self.user_ids = ["U{:05d}".format(i) for i in range(users)]
+        self._lock = threading.Lock()
+        self._conversations = {}
+        self._pending = {}
+        self._latencies = []
+        self._sent = 0
+        self._replies = 0
+        self._completed = 0
+        self._watching = set()
+        self._peak_threads = 0
+
+    def create_bot(self):
+        os.environ.setdefault('STATE_STORE', 'none')
+        os.environ.setdefault('WATSON_WORKSPACE_ID', 'load-test')
+        # The fake bot identity must not end up in the cache of the real bot
+        os.environ.setdefault('BOT_IDENTITY_FILE', os.devnull)
+        self.slack = FakeSlackClient(self.user_ids, self._on_message, self.latency, self.error_rate, self.seed)
+        self.google = FakeGoogleMapsClient(clear_after=self.clear_after, latency=self.latency,
+                                           error_rate=self.error_rate, seed=self.seed)
+        self.watson = FakeConversation(self.latency, self.error_rate, self.seed)
+        gmaps = GoogleWrapper(client=self.google, geocode_cache=GeocodeCache(":memory:"))
+        bot = TravelAdvisor(slack_client=self.slack, gmaps=gmaps, conversation=self.watson)
+        for name in self.SCALED_DELAYS:
+            setattr(bot, name, getattr(bot, name) * self.time_scale)
+        bot.scheduler.tick = max(0.01, bot.scheduler.tick * self.time_scale)
+        bot.scheduler.baseline_delay = bot.CHECK_TRAVEL_DELAY
+        return bot
+
+    def run(self, replay=None, speed=1.0):
+        """
+        :param replay: path of a JSON lines file of RTM events to send instead of the simulated users
+        :param speed: factor by which the recorded events are replayed faster
+        :return: dict with the results
+        """
+        events = self.load_replay(replay) if replay else None
+        self.bot = self.create_bot()
+        loop = asyncio.new_event_loop()
+        runtime = self.runtime = AsyncRuntime(self.bot, max_workers=self.workers, loop=loop)
+        runtime_thread = threading.Thread(target=self._run_runtime, args=(runtime, loop), daemon=True)
+        runtime_thread.start()
+
+        start = time.time()
+        if replay:
+            self._replay(events, speed)
+        else:
+            for user_id in self.user_ids:
+                origin, destination = self.random.sample(self.PLACES, 2)
+                self._conversations[user_id] = ["Wann soll ich losfahren?", origin, destination, str(self.target_minutes)]
+                self._send_next(user_id)
+        self._monitor(start, replay is not None)
+        elapsed = time.time() - start
+
+        runtime.stop()
+        runtime_thread.join()
+        self.bot.scheduler.stop()
+        return self._report(elapsed)
+
+    def _run_runtime(self, runtime, loop):
+        asyncio.set_event_loop(loop)
+        runtime.run()
+
+    def _send(self, user_id, channel, text):
+        with self._lock:
+            self._pending.setdefault(channel, time.time())
+            self._sent += 1
+        self.slack.inject({"type": "message", "channel": channel, "user": user_id, "text": text, "ts": "{:.6f}".format(time.time())})
+
+    def _send_next(self, user_id):
+        steps = self._conversations[user_id]
+        if steps:
+            self._send(user_id, "D" + user_id, steps.pop(0))
+        else:
+            with self._lock:
+                self._watching.add(user_id)
+
+    def _on_message(self, channel, text):
+        now = time.time()
+        with self._lock:
+            self._replies += 1
+            sent = self._pending.pop(channel, None)
+            if sent is not None:
+                self._latencies.append(now - sent)
+        user_id = channel[1:]
+        if sent is not None and user_id in self._conversations:
+            self._send_next(user_id)
+
+    def load_replay(self, path):
+        """
+            Read the RTM events of a replay file. Lines without an event type, like the entries
+            of a backlog or other JSON lines file, are skipped.
+        :return: list of events
+        """
+        with open(path, encoding="utf-8") as f:
+            lines = [json.loads(line) for line in f if line.strip()]
+        events = [line for line in lines if isinstance(line, dict) and "type" in line]
+        if len(events) < len(lines):
+            self.logger.warning("Skipped {} lines of {} which are no RTM events".format(len(lines) - len(events), path))
+        if not events:
+            raise ValueError("No RTM events in {}".format(path))
+        return events
+
+    def _replay(self, events, speed):
+        first_ts = None
+        start = time.time()
+        for event in events:
+            ts = float(event.get("ts", 0))
+            if first_ts is None:
+                first_ts = ts
+            delay = (ts - first_ts) / speed - (time.time() - start)
+            if delay > 0:
+                time.sleep(delay)
+            if event.get("type") == "message" and "user" in event and "channel" in event:
+                self._send(event["user"], event["channel"], event.get("text", ""))
+            else:
+                self.slack.inject(event)
+
+    def _monitor(self, start, replay):
+        while time.time() - start < self.timeout:
+            self._peak_threads = max(self._peak_threads, threading.active_count())
+            with self._lock:
+                for user_id in list(self._watching):
+                    if user_id not in self.bot.registry:
+                        self._watching.discard(user_id)
+                        self._completed += 1
+                done = not self._pending and (replay or self._completed == self.user_count)
+            if done and (not replay or self.bot.registry.due_count == 0):
+                return
+            time.sleep(self.MONITOR_INTERVAL)
+        self.logger.warning("Load test timed out after {}s".format(self.timeout))
+
+    @staticmethod
+    def percentile(values, percent):
+        if not values:
+            return None
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+    def _report(self, elapsed):
+        upstream_calls = {
+            "slack": dict(self.slack.calls),
+            "google": dict(self.google.calls),
+            "watson": dict(self.watson.calls),
+        }
+        total_calls = self.slack.total_calls + self.google.total_calls + self.watson.total_calls
+        return {
+            "users": self.user_count,
+            "elapsed": elapsed,
+            "messages_sent": self._sent,
+            "replies": self._replies,
+            "messages_per_second": self._sent / elapsed if elapsed else 0.0,
+            "reply_latency_p50": self.percentile(self._latencies, 50),
+            "reply_latency_p99": self.percentile(self._latencies, 99),
+            "peak_threads": self._peak_threads,
+            # ru_maxrss is in kilobytes on Linux
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+            "completed_watches": self._completed,
+            "upstream_calls": upstream_calls,
+            "upstream_errors": {
+                "slack": dict(self.slack.errors),
+                "google": dict(self.google.errors),
+                "watson": dict(self.watson.errors),
+            },
+            "upstream_calls_per_watch": total_calls / self._completed if self._completed else None,
+            "dropped_events": self.runtime.queue.dropped,
+        }
+
+
+def print_report(report):
+    for key, value in report.items():
+        if isinstance(value, float):
+            value = "{:.3f}".format(value)
+        print("{:<26} {}".format(key, value))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline load test of the travel advisor")
+    parser.add_argument("--users", type=int, default=10, help="number of simulated users")
+    parser.add_argument("--latency", type=float, default=0.05, help="mean latency of every upstream call in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of failing upstream calls")
+    parser.add_argument("--target-minutes", type=int, default=35, help="travel time the users wait for")
+    parser.add_argument("--clear-after", type=float, default=20.0, help="seconds until the simulated traffic clears")
+    parser.add_argument("--time-scale", type=float, default=0.01, help="factor applied to all delays of the bot")
+    parser.add_argument("--workers", type=int, default=AsyncRuntime.MAX_WORKERS, help="workers of the asyncio runtime")
+    parser.add_argument("--timeout", type=float, default=120.0, help="maximum duration of the test in seconds")
+    parser.add_argument("--replay", help="JSON lines file of recorded RTM events to replay instead")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed factor")
+    parser.add_argument("--seed", type=int, help="seed of the random generators")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    load_test = LoadTest(users=args.users, latency=args.latency, error_rate=args.error_rate,
+                         target_minutes=args.target_minutes, clear_after=args.clear_after,
+                         time_scale=args.time_scale, workers=args.workers, timeout=args.timeout, seed=args.seed)
+    report = load_test.run(replay=args.replay, speed=args.speed)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
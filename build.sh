@@ -1,4 +1,7 @@
 #!/bin/bash
 git describe --always > VERSION
 date >> VERSION
-echo "Updated VERSION file"
\ No newline at end of file
+echo "Updated VERSION file"
+if [ -n "$SLACK_BOT_TOKEN" ]; then
+    python3 BotIdentity.py
+fi
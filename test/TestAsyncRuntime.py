@@ -0,0 +1,166 @@
+import asyncio
+import socket
+import threading
+import time
+import unittest
+
+from AsyncRuntime import AsyncRuntime
+
+
+class Bot:
+    """
+        Records every handled command. Commands wait for release if it is set, so tests can
+        see how many run at the same time.
+    """
+
+    def __init__(self, slack_client=None, release=None):
+        self.slack_client = slack_client
+        self.release = release
+        self.handled = []
+        self.running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+
+    def parse_slack_output(self, events):
+        for event in events:
+            yield event["text"], event["channel"], event["user"], False
+
+    def handle_command(self, command, user_id, channel, is_AT_bot):
+        with self._lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        if self.release is not None:
+            self.release.wait(5)
+        time.sleep(0.01)
+        with self._lock:
+            self.running -= 1
+            self.handled.append((user_id, command))
+
+
+class Websocket:
+
+    def __init__(self):
+        self.sock, self.peer = socket.socketpair()
+
+    def close(self):
+        self.sock.close()
+        self.peer.close()
+
+
+class SlackClient:
+    """
+        Slack client whose websocket is a socket pair. The first rtm_read fails like a closed
+        RTM websocket, rtm_connect opens a new websocket if reconnect is True.
+    """
+
+    def __init__(self, reconnect=True):
+        self.reconnect = reconnect
+        self.server = type("Server", (), {})()
+        self.server.websocket = Websocket()
+        self.websockets = [self.server.websocket]
+        self.connects = 0
+        self.events = []
+
+    def rtm_read(self):
+        websocket = self.server.websocket
+        websocket.sock.recv(1024)
+        if websocket is self.websockets[0]:
+            raise ConnectionError("Unable to send due to closed RTM websocket")
+        events, self.events = self.events, []
+        return events
+
+    def rtm_connect(self, **kwargs):
+        self.connects += 1
+        if not self.reconnect:
+            return False
+        self.server.websocket = Websocket()
+        self.websockets.append(self.server.websocket)
+        return True
+
+    def close(self):
+        for websocket in self.websockets:
+            websocket.close()
+
+
+def event(user, text):
+    return {"type": "message", "user": user, "channel": "D" + user, "text": text}
+
+
+class TestAsyncRuntime(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def run_until_idle(self, runtime):
+        async def idle():
+            while not runtime.idle:
+                await asyncio.sleep(0.01)
+        self.loop.run_until_complete(asyncio.wait_for(idle(), 5))
+
+    def test_events_are_handled(self):
+        bot = Bot()
+        runtime = AsyncRuntime(bot, loop=self.loop)
+        runtime.dispatch([event("U1", "Mainz"), event("U2", "Wiesbaden")])
+        self.run_until_idle(runtime)
+        self.assertEqual([("U1", "Mainz"), ("U2", "Wiesbaden")], sorted(bot.handled))
+
+    def test_running_tasks_are_bounded_by_workers(self):
+        release = threading.Event()
+        bot = Bot(release=release)
+        runtime = AsyncRuntime(bot, max_workers=2, loop=self.loop)
+        runtime.dispatch([event("U{}".format(i), "Mainz") for i in range(5)])
+        self.assertEqual(2, runtime._running_tasks)
+        self.assertEqual(3, runtime.queue.backlog)
+        release.set()
+        self.run_until_idle(runtime)
+        self.assertEqual(5, len(bot.handled))
+        self.assertEqual(2, bot.max_running)
+
+    def test_events_of_one_user_are_handled_in_order(self):
+        bot = Bot()
+        runtime = AsyncRuntime(bot, max_workers=4, loop=self.loop)
+        runtime.dispatch([event("U1", str(i)) for i in range(5)] + [event("U2", "Mainz")])
+        self.run_until_idle(runtime)
+        self.assertEqual(["0", "1", "2", "3", "4"], [command for user, command in bot.handled if user == "U1"])
+        self.assertEqual(["Mainz"], [command for user, command in bot.handled if user == "U2"])
+
+    def test_failed_read_reconnects_and_watches_new_websocket(self):
+        slack_client = SlackClient()
+        bot = Bot(slack_client)
+        runtime = AsyncRuntime(bot, loop=self.loop)
+        runtime._watch_websocket()
+        closed = slack_client.websockets[0]
+        closed.peer.send(b"x")
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertEqual(1, slack_client.connects)
+        self.assertFalse(self.loop.remove_reader(closed.sock.fileno()))
+
+        slack_client.events.append(event("U1", "Mainz"))
+        slack_client.server.websocket.peer.send(b"x")
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.run_until_idle(runtime)
+        self.assertEqual([("U1", "Mainz")], bot.handled)
+        runtime._unwatch_websocket()
+        slack_client.close()
+
+    def test_failed_reconnect_stops_the_loop(self):
+        slack_client = SlackClient(reconnect=False)
+        runtime = AsyncRuntime(Bot(slack_client), loop=self.loop)
+        slack_client.websockets[0].peer.send(b"x")
+        timeout = self.loop.call_later(5, self.loop.stop)
+        started = time.time()
+        runtime.run()
+        self.assertLess(time.time() - started, 5)
+        self.assertEqual(1, slack_client.connects)
+        self.assertFalse(self.loop.remove_reader(slack_client.websockets[0].sock.fileno()))
+        timeout.cancel()
+        slack_client.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
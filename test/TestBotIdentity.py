@@ -0,0 +1,42 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from BotIdentity import BotIdentity
+
+
+class SlackClient:
+
+    def __init__(self, response):
+        self.response = response
+        self.calls = []
+
+    def api_call(self, method, **kwargs):
+        self.calls.append(method)
+        return self.response
+
+
+class TestBotIdentity(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "BOT_IDENTITY")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_auth_test_answer_is_cached(self):
+        slack_client = SlackClient({"ok": True, "user_id": "U79Q3RS22", "user": "travel-advisor"})
+        self.assertEqual("U79Q3RS22", BotIdentity("xoxb-1", self.path).resolve(slack_client))
+        self.assertEqual("U79Q3RS22", BotIdentity("xoxb-1", self.path).resolve(slack_client))
+        self.assertEqual(["auth.test"], slack_client.calls)
+
+    def test_cache_of_another_token_is_ignored(self):
+        BotIdentity("xoxb-1", self.path).save("U79Q3RS22")
+        self.assertIsNone(BotIdentity("xoxb-2", self.path).load())
+
+    def test_failed_auth_test_is_not_cached(self):
+        identity = BotIdentity("xoxb-1", self.path)
+        self.assertIsNone(identity.resolve(SlackClient({"ok": False, "error": "invalid_auth"})))
+        self.assertFalse(os.path.exists(self.path))
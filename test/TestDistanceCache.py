@@ -0,0 +1,34 @@
+import time
+import unittest
+
+from DistanceCache import DistanceCache
+
+
+class TestDistanceCache(unittest.TestCase):
+
+    def test_nearby_coordinates_share_entry(self):
+        cache = DistanceCache()
+        key = cache.key({"lat": 50.00001, "lng": 8.00001}, {"lat": 49.9, "lng": 8.2}, "driving", "best_guess")
+        cache.put(key, {"duration": 1})
+        other = cache.key({"lat": 50.00004, "lng": 7.99998}, {"lat": 49.9, "lng": 8.2}, "driving", "best_guess")
+        self.assertEqual({"duration": 1}, cache.get(other))
+        self.assertEqual(1, cache.hits)
+
+    def test_entries_expire(self):
+        cache = DistanceCache(ttl=0.01)
+        key = cache.key("Mainz", "Wiesbaden", "driving", "best_guess")
+        cache.put(key, {"duration": 1})
+        time.sleep(0.02)
+        self.assertIsNone(cache.get(key))
+        self.assertEqual(0, len(cache))
+        self.assertEqual(1, cache.misses)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = DistanceCache(max_entries=2)
+        for name in ("a", "b"):
+            cache.put(cache.key(name, "x", "driving", None), name)
+        cache.get(cache.key("a", "x", "driving", None))
+        cache.put(cache.key("c", "x", "driving", None), "c")
+        self.assertEqual(2, len(cache))
+        self.assertIsNone(cache.get(cache.key("b", "x", "driving", None)))
+        self.assertEqual("a", cache.get(cache.key("a", "x", "driving", None)))
@@ -0,0 +1,30 @@
+import unittest
+
+from EventQueue import EventQueue
+
+
+class TestEventQueue(unittest.TestCase):
+
+    def test_events_of_one_user_are_handed_out_in_order(self):
+        queue = EventQueue()
+        queue.put("U1", "first")
+        queue.put("U1", "second")
+        queue.put("U2", "other")
+        self.assertEqual(("U1", "first"), queue.get())
+        # U1 is still in progress so U2 is served next
+        self.assertEqual(("U2", "other"), queue.get())
+        self.assertIsNone(queue.get())
+        queue.task_done("U1")
+        self.assertEqual(("U1", "second"), queue.get())
+
+    def test_events_are_dropped_when_full(self):
+        queue = EventQueue(maxsize=2)
+        self.assertTrue(queue.put("U1", 1))
+        self.assertTrue(queue.put("U2", 2))
+        self.assertFalse(queue.put("U3", 3))
+        self.assertEqual(3, queue.received)
+        self.assertEqual(1, queue.dropped)
+        self.assertEqual(2, queue.backlog)
+        queue.get()
+        self.assertEqual(1, queue.backlog)
+        self.assertEqual(2, queue.max_backlog)
@@ -0,0 +1,66 @@
+import os
+import tempfile
+import unittest
+
+from GeocodeCache import GeocodeCache
+
+
+MAINZ = [{"address": "Mainz, Deutschland", "geocode": {"lat": 49.99, "lng": 8.24}}]
+MAINZ_KASTEL = [{"address": "Mainz-Kastel, Wiesbaden", "geocode": {"lat": 50.01, "lng": 8.28}}]
+
+
+class TestGeocodeCache(unittest.TestCase):
+
+    def test_queries_are_normalized(self):
+        cache = GeocodeCache(":memory:")
+        cache.put("  Mainz,  Hauptbahnhof ", GeocodeCache.SOURCE_GEOCODE, MAINZ)
+        self.assertEqual((GeocodeCache.SOURCE_GEOCODE, MAINZ), cache.get("mainz hauptbahnhof"))
+        self.assertIsNone(cache.get("mainz"))
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(1, cache.misses)
+
+    def test_survives_reopen(self):
+        path = os.path.join(tempfile.mkdtemp(), "geocode.sqlite")
+        cache = GeocodeCache(path)
+        cache.put("Mainz", GeocodeCache.SOURCE_PLACES, MAINZ)
+        cache.close()
+        self.assertEqual((GeocodeCache.SOURCE_PLACES, MAINZ), GeocodeCache(path).get("Mainz"))
+
+    def test_file_is_shared_by_shards(self):
+        path = os.path.join(tempfile.mkdtemp(), "geocode.sqlite")
+        first, second = GeocodeCache(path), GeocodeCache(path)
+        self.assertEqual("wal", first._connection.execute("PRAGMA journal_mode").fetchone()[0])
+        first.put("Mainz", GeocodeCache.SOURCE_PLACES, MAINZ)
+        second.put("Mainz-Kastel", GeocodeCache.SOURCE_PLACES, MAINZ_KASTEL)
+        self.assertEqual((GeocodeCache.SOURCE_PLACES, MAINZ), second.get("Mainz"))
+        self.assertEqual((GeocodeCache.SOURCE_PLACES, MAINZ_KASTEL), first.get("Mainz-Kastel"))
+        first.close()
+        second.close()
+
+    def test_expired_entries_are_ignored(self):
+        cache = GeocodeCache(":memory:", max_age=-1)
+        cache.put("Mainz", GeocodeCache.SOURCE_GEOCODE, MAINZ)
+        self.assertIsNone(cache.get("Mainz"))
+        self.assertEqual([], cache.search("mai"))
+
+    def test_queries_without_locations_expire_early(self):
+        cache = GeocodeCache(":memory:", negative_max_age=-1)
+        cache.put("Mianz", GeocodeCache.SOURCE_NONE, [])
+        cache.put("Mainz", GeocodeCache.SOURCE_GEOCODE, MAINZ)
+        self.assertIsNone(cache.get("Mianz"))
+        self.assertEqual((GeocodeCache.SOURCE_GEOCODE, MAINZ), cache.get("Mainz"))
+
+    def test_oldest_entries_are_evicted(self):
+        cache = GeocodeCache(":memory:", max_entries=1)
+        cache.put("Mainz", GeocodeCache.SOURCE_GEOCODE, MAINZ)
+        cache.put("Mainz Kastel", GeocodeCache.SOURCE_GEOCODE, MAINZ_KASTEL)
+        self.assertEqual(1, len(cache))
+        self.assertIsNone(cache.get("Mainz"))
+
+    def test_search_by_prefix(self):
+        cache = GeocodeCache(":memory:")
+        cache.put("Mainz", GeocodeCache.SOURCE_GEOCODE, MAINZ)
+        cache.put("Kastel Mainz", GeocodeCache.SOURCE_GEOCODE, MAINZ_KASTEL)
+        self.assertEqual(MAINZ_KASTEL + MAINZ, cache.search("mai"))
+        self.assertEqual(MAINZ_KASTEL, cache.search("mainz kas"))
+        self.assertEqual([], cache.search("wiesbaden"))
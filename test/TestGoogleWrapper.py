@@ -1,7 +1,14 @@
+import json
 import unittest
 import os
 
+import requests
+
+from DistanceCache import DistanceCache
+from GeocodeCache import GeocodeCache
 from GoogleWrapper import GoogleWrapper
+from HttpTransport import HttpTransport
+from RateLimiter import RateLimiter
 
 
 class TestGoogleWrapper(unittest.TestCase):
@@ -25,4 +32,55 @@ class TestGoogleWrapper(unittest.TestCase):
         origin = 'Mainz'
         gmaps = GoogleWrapper()
         result = gmaps.get_geocode_for_location(origin)
-        print(result)
\ No newline at end of file
+        print(result)
+
+OK_BODY = {"status": "OK", "rows": [{"elements": [{"status": "OK", "distance": {"value": 1000},
+                                                   "duration": {"value": 60}, "duration_in_traffic": {"value": 90}}]}]}
+
+
+def response(status_code, body=None):
+    result = requests.Response()
+    result.status_code = status_code
+    result._content = json.dumps(body or {}).encode("utf-8")
+    return result
+
+
+class TestGoogleWrapperRetries(unittest.TestCase):
+    """
+        Retries of a real googlemaps.Client whose HTTP responses are replaced.
+    """
+
+    def create_wrapper(self, responses):
+        self.requests = []
+        transport = HttpTransport()
+
+        def request(method, url, **kwargs):
+            self.requests.append(url)
+            return responses.pop(0)
+
+        transport.session.request = request
+        limiter = RateLimiter({"google": (100.0, 10)})
+        limiter.BACKOFF_BASE = 0.001
+        return GoogleWrapper("AIzaTestKey", cache=DistanceCache(), geocode_cache=GeocodeCache(":memory:"),
+                             limiter=limiter, transport=transport)
+
+    def test_first_attempt_is_sent(self):
+        gmaps = self.create_wrapper([response(200, OK_BODY)])
+        self.assertEqual(90, gmaps.get_distance_matrix((50.0, 8.0), (50.1, 8.1))["duration_in_traffic"]["value"])
+        self.assertEqual(1, len(self.requests))
+
+    def test_server_errors_are_retried_by_the_limiter_only(self):
+        gmaps = self.create_wrapper([response(503), response(500), response(200, OK_BODY)])
+        self.assertEqual(90, gmaps.get_distance_matrix((50.0, 8.0), (50.1, 8.1))["duration_in_traffic"]["value"])
+        self.assertEqual(3, len(self.requests))
+
+    def test_over_query_limit_is_retried(self):
+        gmaps = self.create_wrapper([response(200, {"status": "OVER_QUERY_LIMIT"}), response(200, OK_BODY)])
+        self.assertEqual(90, gmaps.get_distance_matrix((50.0, 8.0), (50.1, 8.1))["duration_in_traffic"]["value"])
+        self.assertEqual(2, len(self.requests))
+
+    def test_retries_are_limited(self):
+        gmaps = self.create_wrapper([response(503) for _ in range(10)])
+        with self.assertRaises(Exception):
+            gmaps.get_distance_matrix((50.0, 8.0), (50.1, 8.1))
+        self.assertEqual(RateLimiter.MAX_RETRIES + 1, len(self.requests))
@@ -0,0 +1,82 @@
+import http.server
+import socketserver
+import threading
+import time
+import unittest
+
+import requests
+
+from HttpTransport import HttpTransport
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path == "/slow":
+            time.sleep(1)
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class TestHttpTransport(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = Server(("127.0.0.1", 0), Handler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = "http://127.0.0.1:{}/".format(cls.server.server_port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_connections_are_reused(self):
+        transport = HttpTransport()
+        for _ in range(3):
+            self.assertEqual("ok", transport.get(self.url).text)
+        stats = transport.stats()["127.0.0.1"]
+        self.assertEqual(1, stats["connections"])
+        self.assertEqual(2, stats["reused"])
+
+    def test_stalled_requests_time_out(self):
+        transport = HttpTransport(read_timeout=0.1)
+        with self.assertRaises(requests.exceptions.Timeout):
+            transport.get(self.url + "slow")
+
+    def test_session_of_client_is_replaced(self):
+        client = type("Client", (), {})()
+        client.session = requests.Session()
+        transport = HttpTransport()
+        self.assertTrue(transport.attach(client))
+        self.assertIs(transport, client.session)
+        self.assertFalse(transport.attach(object()))
+
+    def test_slack_api_calls_are_posted_through_the_transport(self):
+        calls = []
+        transport = HttpTransport()
+        transport.request = lambda method, url, **kwargs: calls.append((method, url, kwargs))
+        api_requester = type("SlackRequest", (), {"proxies": None, "get_user_agent": lambda self: "test"})()
+        transport.attach_slack(api_requester)
+        api_requester.post_http_request("xoxb-1", "chat.postMessage", {"channel": "D1"})
+        method, url, kwargs = calls[0]
+        self.assertEqual(("POST", "https://slack.com/api/chat.postMessage"), (method, url))
+        self.assertEqual("Bearer xoxb-1", kwargs["headers"]["Authorization"])
+        self.assertEqual({"channel": "D1"}, kwargs["data"])
+
+    def test_timeouts_are_added_to_client_requests(self):
+        client = type("Service", (), {})()
+        client.request = lambda url, **kwargs: requests.request("GET", url, **kwargs)
+        HttpTransport(read_timeout=0.1).attach_timeouts(client)
+        with self.assertRaises(requests.exceptions.Timeout):
+            client.request(self.url + "slow")
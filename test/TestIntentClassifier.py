@@ -0,0 +1,40 @@
+import configparser
+import os
+import unittest
+
+from IntentClassifier import IntentClassifier
+
+
+class TestIntentClassifier(unittest.TestCase):
+
+    def setUp(self):
+        self.intents = configparser.ConfigParser()
+        self.intents.read(os.path.join(os.path.dirname(__file__), os.pardir, "intents.conf"))
+        self.remote_calls = []
+
+    def remote_classifier(self, text):
+        self.remote_calls.append(text)
+        return "remote"
+
+    def test_obvious_messages_are_classified_locally(self):
+        classifier = IntentClassifier(self.intents, self.remote_classifier)
+        self.assertEqual("when_should_I_leave", classifier.classify("Wann soll ich losfahren?"))
+        self.assertEqual("say_hello", classifier.classify("Hallo!"))
+        self.assertEqual("cancel_request", classifier.classify("abbrechen"))
+        self.assertIsNone(classifier.classify(" 2 "))
+        self.assertEqual([], self.remote_calls)
+        self.assertEqual(4, classifier.avoided_calls)
+
+    def test_remote_answers_are_cached(self):
+        classifier = IntentClassifier(self.intents, self.remote_classifier)
+        self.assertEqual("remote", classifier.classify("Mainz Hauptbahnhof"))
+        self.assertEqual("remote", classifier.classify("mainz  hauptbahnhof"))
+        self.assertEqual(["Mainz Hauptbahnhof"], self.remote_calls)
+        self.assertEqual(1, classifier.cache_hits)
+
+    def test_cache_is_bounded(self):
+        classifier = IntentClassifier(self.intents, self.remote_classifier, cache_size=1)
+        classifier.classify("a")
+        classifier.classify("b")
+        classifier.classify("a")
+        self.assertEqual(["a", "b", "a"], self.remote_calls)
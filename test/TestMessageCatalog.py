@@ -0,0 +1,57 @@
+import os
+import tempfile
+import time
+import unittest
+
+from MessageCatalog import MessageCatalog, MessageCatalogError
+
+
+MESSAGES_CONFIG_FILE = os.path.join(os.path.dirname(__file__), os.pardir, "messages.conf")
+
+
+class TestMessageCatalog(unittest.TestCase):
+
+    def write_messages(self, content):
+        path = os.path.join(tempfile.mkdtemp(), "messages.conf")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(content)
+        return path
+
+    def test_messages_config_is_valid(self):
+        messages = MessageCatalog(MESSAGES_CONFIG_FILE)
+        self.assertIn("5", messages.render("I_WILL_NOTIFY", 5))
+        self.assertNotEqual(messages.render("ORIGIN"), messages.render("ORIGIN", locale="en"))
+
+    def test_missing_locale_message_falls_back_to_default(self):
+        path = self.write_messages('[DEFAULT]\nORIGIN = "Von wo?"\nDESTINATION = "Wohin?"\n\n[en]\nORIGIN = "From where?"\n')
+        messages = MessageCatalog(path, locale="en")
+        self.assertEqual("From where?", messages.render("ORIGIN"))
+        self.assertEqual("Wohin?", messages.render("DESTINATION"))
+        self.assertEqual("Von wo?", messages.render("ORIGIN", locale="fr"))
+
+    def test_unquoted_template_is_rejected(self):
+        path = self.write_messages('[DEFAULT]\n"ORIGIN = "Von wo?"\n')
+        self.assertRaises(MessageCatalogError, MessageCatalog, path)
+
+    def test_wrong_placeholders_are_rejected(self):
+        path = self.write_messages('[DEFAULT]\nI_WILL_NOTIFY = "Ich gebe dir Bescheid"\n')
+        self.assertRaises(MessageCatalogError, MessageCatalog, path)
+        path = self.write_messages('[DEFAULT]\nORIGIN = "Von {name}?"\n')
+        self.assertRaises(MessageCatalogError, MessageCatalog, path)
+
+    def test_changed_file_is_reloaded(self):
+        path = self.write_messages('[DEFAULT]\nORIGIN = "Von wo?"\n')
+        messages = MessageCatalog(path, reload_interval=0)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write('[DEFAULT]\nORIGIN = "Woher?"\n')
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        self.assertEqual("Woher?", messages.render("ORIGIN"))
+
+    def test_broken_reload_keeps_previous_templates(self):
+        path = self.write_messages('[DEFAULT]\nORIGIN = "Von wo?"\n')
+        messages = MessageCatalog(path, reload_interval=0)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write('[DEFAULT]\nORIGIN = Woher?\n')
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        with self.assertLogs(MessageCatalog.logger.name):
+            self.assertEqual("Von wo?", messages.render("ORIGIN"))
@@ -0,0 +1,56 @@
+import threading
+import time
+import unittest
+
+from Metrics import Metrics, SamplingProfiler
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_timer_records_latency_and_errors(self):
+        metrics = Metrics()
+        with metrics.timer("upstream", endpoint="google.geocode"):
+            pass
+        with self.assertRaises(ValueError):
+            with metrics.timer("upstream", endpoint="google.geocode"):
+                raise ValueError()
+        with metrics.timer("upstream", endpoint="slack.chat.postMessage") as timer:
+            timer.fail()
+        self.assertEqual(2, metrics.histogram("upstream_seconds", endpoint="google.geocode").count)
+        self.assertEqual(1, metrics.counter_value("upstream_errors_total", endpoint="google.geocode"))
+        self.assertEqual(1, metrics.counter_value("upstream_errors_total", endpoint="slack.chat.postMessage"))
+
+    def test_prometheus_text(self):
+        metrics = Metrics(buckets=(0.1, 1.0))
+        metrics.observe("command_seconds", 0.5, context="none")
+        metrics.inc("travel_checks_total", 3)
+        metrics.gauge("active_watches", lambda: 2)
+        text = metrics.render_prometheus()
+        self.assertIn("# TYPE command_seconds histogram", text)
+        self.assertIn('command_seconds_bucket{context="none",le="0.1"} 0', text)
+        self.assertIn('command_seconds_bucket{context="none",le="1.0"} 1', text)
+        self.assertIn('command_seconds_bucket{context="none",le="+Inf"} 1', text)
+        self.assertIn("travel_checks_total 3", text)
+        self.assertIn("active_watches 2", text)
+
+    def test_snapshot_has_quantiles(self):
+        metrics = Metrics(buckets=(0.1, 1.0))
+        for value in (0.05, 0.05, 0.5):
+            metrics.observe("poll_batch_seconds", value)
+        histogram = metrics.to_dict()["histograms"]["poll_batch_seconds"]
+        self.assertEqual(3, histogram["count"])
+        self.assertEqual(0.1, histogram["p50"])
+        self.assertEqual(1.0, histogram["p99"])
+
+    def test_profiler_samples_other_threads(self):
+        stopped = threading.Event()
+        worker = threading.Thread(target=stopped.wait)
+        worker.start()
+        profiler = SamplingProfiler(interval=0.001)
+        profiler.start()
+        time.sleep(0.05)
+        profiler.stop()
+        stopped.set()
+        worker.join()
+        self.assertFalse(profiler.running)
+        self.assertIn("threading.py:wait", profiler.folded())
@@ -0,0 +1,125 @@
+import threading
+import time
+import unittest
+
+from GeocodeCache import GeocodeCache
+from GoogleWrapper import GoogleWrapper
+from Metrics import metrics
+from PollingScheduler import PollingScheduler
+from TravelRequest import TravelRequest
+
+
+class FakeGoogleWrapper:
+
+    def __init__(self):
+        self.calls = []
+
+    def get_distance_matrices(self, origins, destinations):
+        self.calls.append((origins, destinations))
+        result = {"distance": {"value": 1}, "duration": {"value": 60}, "duration_in_traffic": {"value": 90}}
+        return [[result for _ in destinations] for _ in origins]
+
+
+class NoRouteClient:
+    """
+        googlemaps.Client stand-in which finds no route to destinations east of no_route_lng.
+    """
+
+    def __init__(self, no_route_lng):
+        self.no_route_lng = no_route_lng
+        self.elements = 0
+
+    def distance_matrix(self, origins, destinations, **kwargs):
+        self.elements += len(origins) * len(destinations)
+        rows = []
+        for _ in origins:
+            elements = []
+            for destination in destinations:
+                if destination["lng"] >= self.no_route_lng:
+                    elements.append({"status": "ZERO_RESULTS"})
+                else:
+                    elements.append({"status": "OK", "distance": {"value": 1}, "duration": {"value": 60},
+                                     "duration_in_traffic": {"value": 90}})
+            rows.append({"elements": elements})
+        return {"rows": rows}
+
+
+def location(lat, lng):
+    return {"address": "{},{}".format(lat, lng), "geocode": {"lat": lat, "lng": lng}}
+
+
+class TestPollingScheduler(unittest.TestCase):
+
+    def test_create_batches_shares_origins(self):
+        requests = [TravelRequest("D1", location(50.0, 8.0), location(50.1, 8.1 + i)) for i in range(30)]
+        batches = PollingScheduler.create_batches(requests)
+        self.assertEqual(2, len(batches))
+        self.assertEqual(25, len(batches[0]))
+        self.assertEqual(5, len(batches[1]))
+
+    def test_create_batches_only_groups_shared_locations(self):
+        requests = [TravelRequest("D1", location(50.0 + i, 8.0), location(50.1, 8.1 + i)) for i in range(11)]
+        requests += [TravelRequest("D1", location(60.0 + i, 8.0), location(51.0, 9.0)) for i in range(3)]
+        batches = PollingScheduler.create_batches(requests)
+        self.assertEqual(12, len(batches))
+        for batch in batches:
+            origins = {r.origin["geocode"]["lat"] for r in batch}
+            destinations = {r.destination["geocode"]["lng"] for r in batch}
+            self.assertEqual(len(batch), len(origins) * len(destinations))
+
+    def test_request_without_route_does_not_fail_its_batch(self):
+        client = NoRouteClient(no_route_lng=9.0)
+        gmaps = GoogleWrapper(client=client, geocode_cache=GeocodeCache(":memory:"))
+        checked = []
+        failed = []
+        scheduler = PollingScheduler(gmaps, checked.append, failure_callback=failed.append)
+        requests = [TravelRequest("D1", location(50.0, 8.0), location(50.1, 8.5)),
+                    TravelRequest("D2", location(50.0, 8.0), location(50.1, 9.5))]
+        scheduler._check_batch(requests)
+        self.assertEqual([requests[0]], checked)
+        self.assertEqual([requests[1]], failed)
+        self.assertEqual(90, requests[0].duration_in_traffic["value"])
+        self.assertEqual(2, client.elements)
+
+    def test_due_requests_are_checked_in_one_call(self):
+        gmaps = FakeGoogleWrapper()
+        checked = []
+        done = threading.Event()
+
+        def callback(request):
+            checked.append(request)
+            if len(checked) == 3:
+                done.set()
+
+        scheduler = PollingScheduler(gmaps, callback, tick=0.05)
+        scheduler.start()
+        try:
+            for i in range(3):
+                scheduler.schedule(TravelRequest("D1", location(50.0, 8.0), location(50.1, 8.1 + i)), 0)
+            self.assertTrue(done.wait(2))
+        finally:
+            scheduler.stop()
+        self.assertEqual(1, len(gmaps.calls))
+        self.assertEqual(3, len(gmaps.calls[0][1]))
+        self.assertTrue(all(r.duration_in_traffic["value"] == 90 for r in checked))
+
+    def test_saved_checks_compare_checks_made_with_fixed_interval(self):
+        scheduler = PollingScheduler(FakeGoogleWrapper(), lambda request: None, baseline_delay=0.01)
+        request = TravelRequest("D1", location(50.0, 8.0), location(50.1, 8.1))
+        scheduler._check_batch([request])
+        time.sleep(0.1)
+        scheduler._check_batch([request])
+        self.assertEqual(2, scheduler.checks_made)
+        self.assertGreater(scheduler.checks_saved, 5)
+        self.assertIn("checks_saved {}".format(scheduler.checks_saved), metrics.render_prometheus())
+        scheduler.baseline_delay = 1.0
+        self.assertLess(scheduler.checks_saved, 0)
+
+    def test_cancelled_request_is_not_checked(self):
+        gmaps = FakeGoogleWrapper()
+        scheduler = PollingScheduler(gmaps, lambda request: None)
+        request = TravelRequest("D1", location(50.0, 8.0), location(50.1, 8.1))
+        scheduler.schedule(request, 0)
+        scheduler.cancel(request)
+        self.assertEqual(0, len(scheduler))
+        self.assertEqual([], scheduler.registry.pop_due(float("inf")))
@@ -0,0 +1,91 @@
+import threading
+import time
+import unittest
+
+from RateLimiter import RateLimiter, RateLimitExceeded, TokenBucket
+
+
+class UpstreamError(Exception):
+
+    def __init__(self, status_code):
+        super().__init__(status_code)
+        self.status_code = status_code
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def create_limiter(self, rate=100.0, capacity=4):
+        limiter = RateLimiter({"google": (rate, capacity)}, background_timeout=0.05)
+        limiter.BACKOFF_BASE = 0.001
+        return limiter
+
+    def test_server_errors_are_retried(self):
+        limiter = self.create_limiter()
+        errors = [UpstreamError(503), UpstreamError(429)]
+
+        def call():
+            if errors:
+                raise errors.pop(0)
+            return "ok"
+
+        self.assertEqual("ok", limiter.call("google", call))
+
+    def test_client_errors_are_not_retried(self):
+        limiter = self.create_limiter()
+        calls = []
+
+        def call():
+            calls.append(1)
+            raise UpstreamError(400)
+
+        with self.assertRaises(UpstreamError):
+            limiter.call("google", call)
+        self.assertEqual(1, len(calls))
+
+    def test_non_idempotent_calls_are_only_retried_when_rate_limited(self):
+        limiter = self.create_limiter()
+        errors = [UpstreamError(429), UpstreamError(503)]
+
+        def call():
+            if errors:
+                raise errors.pop(0)
+            return "ok"
+
+        with self.assertRaises(UpstreamError):
+            limiter.call("google", call, idempotent=False)
+        self.assertEqual([], errors)
+
+    def test_timeouts_are_retried_if_idempotent(self):
+        timeout = type("Timeout", (Exception,), {})
+        self.assertTrue(RateLimiter.is_retryable(timeout()))
+        self.assertFalse(RateLimiter.is_retryable(timeout(), idempotent=False))
+
+    def test_failed_results_are_retried(self):
+        limiter = self.create_limiter()
+        responses = [{"ok": False, "error": "ratelimited"}, {"ok": True}]
+        result = limiter.call("google", lambda: responses.pop(0), lambda response: not response["ok"])
+        self.assertEqual({"ok": True}, result)
+
+    def test_background_calls_leave_the_reserve(self):
+        limiter = self.create_limiter(rate=0.001, capacity=4)
+        with RateLimiter.lane(RateLimiter.BACKGROUND):
+            for _ in range(3):
+                limiter.call("google", lambda: None)
+            with self.assertRaises(RateLimitExceeded):
+                limiter.call("google", lambda: None)
+        # The reserved token is still available to interactive calls
+        self.assertEqual("ok", limiter.call("google", lambda: "ok"))
+        self.assertEqual(RateLimiter.INTERACTIVE, RateLimiter.current_lane())
+
+    def test_background_waits_for_interactive_callers(self):
+        bucket = TokenBucket(rate=20.0, capacity=1, reserve=0)
+        bucket.acquire(RateLimiter.INTERACTIVE)
+        order = []
+        background = threading.Thread(target=lambda: bucket.acquire(RateLimiter.BACKGROUND) and order.append("background"))
+        interactive = threading.Thread(target=lambda: bucket.acquire(RateLimiter.INTERACTIVE) and order.append("interactive"))
+        interactive.start()
+        time.sleep(0.01)
+        background.start()
+        interactive.join()
+        background.join()
+        self.assertEqual(["interactive", "background"], order)
@@ -0,0 +1,60 @@
+import unittest
+
+from RequestRegistry import RequestRegistry
+from TravelRequest import TravelRequest
+from User import User
+
+
+def create_user(user_id, context=User.CONTEXT_NONE):
+    user = User(user_id)
+    user.add_travel_request(TravelRequest("D" + user_id))
+    user.context = context
+    return user
+
+
+class TestRequestRegistry(unittest.TestCase):
+
+    def test_users_are_indexed_by_context(self):
+        registry = RequestRegistry()
+        alice = create_user("U1", User.CONTEXT_REQUEST_STARTED)
+        registry.add(alice)
+        registry.add(create_user("U2", User.CONTEXT_REQUEST_STARTED))
+        registry.set_context(alice, User.CONTEXT_REQUEST_RUNNING)
+        self.assertEqual([alice], registry.users_in_context(User.CONTEXT_REQUEST_RUNNING))
+        self.assertEqual(1, registry.count_in_context(User.CONTEXT_REQUEST_STARTED))
+        registry.remove("U2")
+        self.assertEqual(0, registry.count_in_context(User.CONTEXT_REQUEST_STARTED))
+        self.assertNotIn("U2", registry)
+        self.assertEqual(1, len(registry))
+
+    def test_due_requests_are_popped_in_order(self):
+        registry = RequestRegistry()
+        first = create_user("U1")
+        second = create_user("U2")
+        registry.set_due(second.travel_request, 20)
+        registry.set_due(first.travel_request, 10)
+        self.assertEqual(10, registry.next_due())
+        self.assertEqual([], registry.pop_due(5))
+        self.assertEqual([first.travel_request, second.travel_request], registry.pop_due(20))
+        self.assertIsNone(registry.next_due())
+
+    def test_rescheduled_and_removed_requests_are_skipped(self):
+        registry = RequestRegistry()
+        rescheduled = create_user("U1")
+        removed = create_user("U2")
+        registry.add(removed)
+        registry.set_due(rescheduled.travel_request, 10)
+        registry.set_due(rescheduled.travel_request, 10)
+        registry.set_due(rescheduled.travel_request, 30)
+        registry.set_due(removed.travel_request, 10)
+        registry.remove("U2")
+        self.assertEqual([], registry.pop_due(20))
+        self.assertEqual(1, registry.due_count)
+        self.assertEqual([rescheduled.travel_request], registry.pop_due(30))
+
+    def test_locations_are_packed(self):
+        location = {"address": "Mainz", "geocode": {"lat": 49.9928617, "lng": 8.2472526}}
+        request = TravelRequest("D1", origin=location)
+        self.assertEqual(location, request.origin)
+        self.assertIsNone(request.destination)
+        self.assertFalse(hasattr(request, "__dict__"))
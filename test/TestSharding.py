@@ -0,0 +1,171 @@
+import multiprocessing
+import queue
+import socket
+import unittest
+from functools import partial
+
+from RequestRegistry import RequestRegistry
+from Sharding import HashRing, ShardFront, ShardWorker
+from User import User
+
+
+class RegistryBot:
+
+    def __init__(self, user_ids):
+        self.registry = RequestRegistry()
+        for user_id in user_ids:
+            self.registry.add(User(user_id))
+
+    def export_user(self, user_id):
+        return self.registry.remove(user_id).to_dict()
+
+
+class ConversationBot(RegistryBot):
+    """
+        Bot of a worker process which remembers the messages of each user in its name
+        and reports every message with the conversation so far to replies.
+    """
+
+    def __init__(self, shard, replies):
+        super().__init__([])
+        self.shard = shard
+        self.replies = replies
+        self.scheduler = type("Scheduler", (), {"stop": lambda self: None})()
+        self.store = None
+
+    def import_user(self, state):
+        self.registry.add(User.from_dict(state))
+
+    def parse_slack_output(self, events):
+        for event in events:
+            yield event["text"], event["channel"], event["user"], False
+
+    def handle_command(self, command, user_id, channel, is_AT_bot):
+        user = self.registry.get(user_id)
+        if user is None:
+            user = User(user_id)
+            self.registry.add(user)
+        user.name = command if user.name is None else user.name + " " + command
+        self.replies.put((self.shard, user_id, user.name))
+
+
+class SlackClient:
+    """
+        Slack client whose websocket is a socket pair. Reads fail as if the websocket was closed
+        whenever the peer sends b"closed". Reconnecting opens a new websocket while reconnects last.
+    """
+
+    def __init__(self, reconnects):
+        self.reconnects = reconnects
+        self.server = type("Server", (), {})()
+        self.sockets = []
+        self.reads = 0
+        self._connect()
+
+    def _connect(self):
+        sock, peer = socket.socketpair()
+        self.sockets.extend((sock, peer))
+        self.server.websocket = type("Websocket", (), {"sock": sock})()
+        peer.send(b"closed")
+
+    def rtm_read(self):
+        self.reads += 1
+        if self.server.websocket.sock.recv(1024) == b"closed":
+            raise ConnectionError("Unable to send due to closed RTM websocket")
+        return []
+
+    def rtm_connect(self, **kwargs):
+        if not self.reconnects:
+            return False
+        self.reconnects -= 1
+        self._connect()
+        return True
+
+    def close(self):
+        for sock in self.sockets:
+            sock.close()
+
+
+def create_conversation_bot(replies, shard):
+    return ConversationBot(shard, replies)
+
+
+class TestSharding(unittest.TestCase):
+
+    USERS = ["U{:05d}".format(i) for i in range(2000)]
+
+    def test_users_are_spread_over_all_shards(self):
+        ring = HashRing(range(4))
+        counts = {}
+        for user_id in self.USERS:
+            shard = ring.get(user_id)
+            counts[shard] = counts.get(shard, 0) + 1
+        self.assertEqual({0, 1, 2, 3}, set(counts))
+        for count in counts.values():
+            self.assertGreater(count, len(self.USERS) / 4 * 0.7)
+
+    def test_adding_a_shard_only_moves_users_to_it(self):
+        ring = HashRing(range(4))
+        before = {user_id: ring.get(user_id) for user_id in self.USERS}
+        ring.add(4)
+        moved = [user_id for user_id in self.USERS if ring.get(user_id) != before[user_id]]
+        self.assertTrue(all(ring.get(user_id) == 4 for user_id in moved))
+        self.assertLess(len(moved), len(self.USERS) / 5 * 1.5)
+        ring.remove(4)
+        self.assertEqual(before, {user_id: ring.get(user_id) for user_id in self.USERS})
+
+    def test_empty_ring_has_no_owner(self):
+        self.assertIsNone(HashRing().get("U1"))
+
+    def test_worker_exports_users_of_other_shards(self):
+        bot = RegistryBot(self.USERS[:50])
+        worker = ShardWorker(0, bot, HashRing([0, 1]), None, None, runtime=object())
+        exported = worker.export_foreign_users()
+        self.assertTrue(exported)
+        self.assertTrue(all(worker.ring.get(state["id"]) == 1 for state in exported))
+        self.assertTrue(all(worker.ring.get(user.id) == 0 for user in bot.registry))
+        self.assertEqual(50, len(exported) + len(bot.registry))
+
+    def test_front_reconnects_and_stops_when_reconnect_fails(self):
+        slack_client = SlackClient(reconnects=1)
+        front = ShardFront(slack_client, 0)
+        try:
+            front.run()
+        finally:
+            slack_client.close()
+        self.assertEqual(0, slack_client.reconnects)
+        self.assertEqual(2, slack_client.reads)
+
+    def test_users_keep_their_conversation_when_shards_change(self):
+        context = multiprocessing.get_context("spawn")
+        replies = context.Queue()
+        front = ShardFront(None, 2, bot_factory=partial(create_conversation_bot, replies), context=context)
+        users = self.USERS[:20]
+        try:
+            self.assertEqual({"from"}, set(self.send(front, replies, users, "from").values()))
+            front.add_worker()
+            conversations = self.send(front, replies, users, "to")
+            self.assertEqual({"from to"}, set(conversations.values()))
+            self.assertIn(2, {front.ring.get(user_id) for user_id in users})
+            front.remove_worker(2)
+            conversations = self.send(front, replies, users, "and back")
+            self.assertEqual({"from to and back"}, set(conversations.values()))
+        finally:
+            front.stop()
+
+    def send(self, front, replies, users, text):
+        """
+            Send text to every user and check each reply comes from the shard owning the user.
+        :return: dict of user id to the conversation so far
+        """
+        front.dispatch([{"type": "message", "channel": "D" + user_id, "user": user_id, "text": text}
+                        for user_id in users])
+        conversations = {}
+        while len(conversations) < len(users):
+            try:
+                shard, user_id, conversation = replies.get(timeout=30)
+            except queue.Empty:
+                self.fail("No reply for {}".format(set(users) - set(conversations)))
+            self.assertEqual(front.ring.get(user_id), shard)
+            conversations[user_id] = conversation
+        return conversations
@@ -0,0 +1,79 @@
+import os
+import tempfile
+import unittest
+
+from RequestRegistry import RequestRegistry
+from StateStore import JournalStateStore, SQLiteStateStore
+from TravelRequest import TravelRequest
+from User import User
+
+
+def create_user(user_id):
+    user = User(user_id, "name")
+    request = TravelRequest("D" + user_id, {"address": "Mainz", "geocode": {"lat": 49.99, "lng": 8.24}})
+    request.target_duration = 600
+    user.add_travel_request(request)
+    return user
+
+
+class StateStoreTests:
+
+    def create_store(self, path):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "state")
+
+    def test_state_survives_restart(self):
+        registry = RequestRegistry(self.create_store(self.path))
+        registry.add(create_user("U1"))
+        registry.add(create_user("U2"))
+        registry.set_context(registry.get("U1"), User.CONTEXT_REQUEST_RUNNING)
+        registry.set_due(registry.get("U1").travel_request, 1234.0)
+        registry.remove("U2")
+        registry.store.flush()
+
+        states = self.create_store(self.path).load()
+        self.assertEqual(1, len(states))
+        user = User.from_dict(states[0])
+        self.assertEqual("U1", user.id)
+        self.assertEqual(User.CONTEXT_REQUEST_RUNNING, user.context)
+        self.assertEqual(600, user.travel_request.target_duration)
+        self.assertEqual(1234.0, user.travel_request.next_check)
+        self.assertEqual("Mainz", user.travel_request.origin["address"])
+
+    def test_changes_are_only_written_on_flush(self):
+        store = self.create_store(self.path)
+        store.record(create_user("U1"))
+        self.assertEqual([], self.create_store(self.path).load())
+        store.flush()
+        self.assertEqual(1, len(self.create_store(self.path).load()))
+
+
+class TestJournalStateStore(StateStoreTests, unittest.TestCase):
+
+    def create_store(self, path):
+        return JournalStateStore(path)
+
+    def test_journal_is_compacted(self):
+        store = self.create_store(self.path)
+        user = create_user("U1")
+        for _ in range(JournalStateStore.COMPACT_MIN_LINES + 1):
+            store.record(user)
+            store.flush()
+        with open(self.path) as f:
+            self.assertEqual(1, len(f.readlines()))
+
+    def test_incomplete_last_line_is_skipped(self):
+        store = self.create_store(self.path)
+        store.record(create_user("U1"))
+        store.flush()
+        with open(self.path, "a") as f:
+            f.write('{"id": "U2", "sta')
+        self.assertEqual(["U1"], [state["id"] for state in self.create_store(self.path).load()])
+
+
+class TestSQLiteStateStore(StateStoreTests, unittest.TestCase):
+
+    def create_store(self, path):
+        return SQLiteStateStore(path)
@@ -0,0 +1,108 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from benchmark.FakeClients import FakeConversation, FakeGoogleMapsClient, FakeSlackClient
+from GeocodeCache import GeocodeCache
+from GoogleWrapper import GoogleWrapper
+from TravelAdvisor import TravelAdvisor
+from User import User
+
+
+class AmbiguousGoogleMapsClient(FakeGoogleMapsClient):
+    """
+        Finds two locations for every address, so the user has to choose one.
+    """
+
+    def geocode(self, address):
+        return super().geocode(address) + super().geocode(address + " Hauptbahnhof")
+
+
+class NoRouteGoogleMapsClient(AmbiguousGoogleMapsClient):
+    """
+        Finds no route between any locations, like between the mainland and an island.
+    """
+
+    def distance_matrix(self, origins, destinations, departure_time=None, **kwargs):
+        return {"rows": [{"elements": [{"status": "ZERO_RESULTS"} for _ in destinations]} for _ in origins]}
+
+
+class TestTravelAdvisor(unittest.TestCase):
+
+    USER = "U1"
+    CHANNEL = "DU1"
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ.update(STATE_STORE="journal", STATE_FILE=os.path.join(self.directory, "state.journal"),
+                          BOT_IDENTITY_FILE=os.devnull, WATSON_WORKSPACE_ID="test")
+        self.bots = []
+        self.replies = []
+
+    def tearDown(self):
+        for bot in self.bots:
+            bot.scheduler.stop()
+            bot.store.stop()
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.directory)
+
+    def start_bot(self, client=None):
+        slack = FakeSlackClient([self.USER], on_message=lambda channel, text: self.replies.append(text))
+        gmaps = GoogleWrapper(client=client or AmbiguousGoogleMapsClient(), geocode_cache=GeocodeCache(":memory:"))
+        bot = TravelAdvisor(slack_client=slack, gmaps=gmaps, conversation=FakeConversation())
+        self.bots.append(bot)
+        return bot
+
+    def restart_bot(self, bot):
+        bot.scheduler.stop()
+        bot.store.stop()
+        return self.start_bot()
+
+    def say(self, bot, text):
+        bot.handle_command(text, self.USER, self.CHANNEL, False)
+
+    def test_choice_of_origin_and_destination_survives_restart(self):
+        bot = self.start_bot()
+        self.say(bot, "Wann soll ich losfahren?")
+        self.say(bot, "Mainz")
+        bot = self.restart_bot(bot)
+        self.assertEqual(2, len(bot.registry.get(self.USER).origins))
+        self.say(bot, "1")
+        user = bot.registry.get(self.USER)
+        self.assertEqual(User.CONTEXT_ORIGIN_SELECTED, user.context)
+        self.assertEqual("Mainz", user.travel_request.origin["address"])
+
+        self.say(bot, "Wiesbaden")
+        bot = self.restart_bot(bot)
+        self.say(bot, "2")
+        user = bot.registry.get(self.USER)
+        self.assertEqual(User.CONTEXT_DESTINATION_SELECTED, user.context)
+        self.assertEqual("Wiesbaden Hauptbahnhof", user.travel_request.destination["address"])
+
+    def test_lost_choices_ask_again(self):
+        bot = self.start_bot()
+        self.say(bot, "Wann soll ich losfahren?")
+        self.say(bot, "Mainz")
+        user = bot.registry.get(self.USER)
+        user.origins = None
+        self.say(bot, "1")
+        self.assertEqual(User.CONTEXT_REQUEST_STARTED, user.context)
+        self.assertEqual(bot.messages.render("ORIGIN"), self.replies[-1])
+
+    def test_missing_route_starts_over(self):
+        bot = self.start_bot(NoRouteGoogleMapsClient())
+        self.say(bot, "Wann soll ich losfahren?")
+        self.say(bot, "Mainz")
+        self.say(bot, "1")
+        self.say(bot, "Helgoland")
+        self.say(bot, "1")
+        user = bot.registry.get(self.USER)
+        self.assertEqual(User.CONTEXT_REQUEST_STARTED, user.context)
+        self.assertIsNone(user.travel_request.origin)
+        self.assertTrue(self.replies[-1].startswith(bot.messages.render("NO_ROUTE_FOUND")))
+
+        self.say(bot, "Wiesbaden")
+        self.assertEqual(User.CONTEXT_ORIGIN_SUPPLIED, user.context)
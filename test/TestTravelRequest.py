@@ -0,0 +1,42 @@
+import unittest
+
+from TravelRequest import TravelRequest
+
+
+def create_request(target_duration, samples):
+    request = TravelRequest("D1", target_duration=target_duration)
+    request.samples.extend(samples)
+    request.duration_in_traffic = {"value": samples[-1][1]}
+    return request
+
+
+class TestTravelRequest(unittest.TestCase):
+
+    def test_trend_of_improving_traffic_is_negative(self):
+        request = create_request(600, [(0, 1200), (120, 1140), (240, 1080)])
+        self.assertAlmostEqual(-0.5, request.trend())
+        self.assertIsNone(create_request(600, [(0, 1200)]).trend())
+
+    def test_delay_grows_with_distance_to_target(self):
+        far = create_request(600, [(0, 3000)])
+        near = create_request(600, [(0, 630)])
+        self.assertEqual(900, far.next_check_delay(60, 900))
+        self.assertEqual(60, near.next_check_delay(60, 900))
+
+    def test_delay_shrinks_when_trend_approaches_target(self):
+        steady = create_request(600, [(0, 900), (120, 900), (240, 900)])
+        improving = create_request(600, [(0, 1000), (120, 950), (240, 900)])
+        self.assertEqual(600, steady.next_check_delay(60, 900))
+        # 300s above target dropping 50s every 120s reaches it in 720s
+        self.assertAlmostEqual(360, improving.next_check_delay(60, 900))
+
+    def test_forecast_finds_earliest_departure(self):
+        class FakeGoogleWrapper:
+            def get_departure_forecast(self, origin, destination, departure_times):
+                return [{"duration_in_traffic": {"value": 1200 - departure_time}} for departure_time in departure_times]
+
+        location = {"address": "Mainz", "geocode": {"lat": 49.99, "lng": 8.24}}
+        request = TravelRequest("D1", location, location, target_duration=900)
+        self.assertEqual(300, request.forecast(FakeGoogleWrapper(), [100, 200, 300, 400]))
+        self.assertEqual(300, request.forecast_departure)
+        self.assertIsNone(request.forecast(FakeGoogleWrapper(), [100, 200]))
@@ -0,0 +1,76 @@
+import threading
+import time
+import unittest
+
+from UserDirectory import UserDirectory
+
+
+class FakeSlackClient:
+
+    def __init__(self, delay=0.0, failures=0):
+        self.delay = delay
+        self.failures = failures
+        self.calls = []
+
+    def api_call(self, method, **kwargs):
+        self.calls.append((method, kwargs))
+        time.sleep(self.delay)
+        if method == "users.list":
+            if self.failures:
+                self.failures -= 1
+                return {"ok": False, "error": "ratelimited"}
+            if kwargs.get("cursor") == "page2":
+                return {"ok": True, "members": [{"id": "U2", "name": "travel-advisor"}],
+                        "response_metadata": {"next_cursor": ""}}
+            return {"ok": True, "members": [{"id": "U1", "name": "alice"}],
+                    "response_metadata": {"next_cursor": "page2"}}
+        if method == "users.info":
+            return {"ok": True, "user": {"id": kwargs["user"], "name": "new"}}
+        return {"ok": False}
+
+
+class TestUserDirectory(unittest.TestCase):
+
+    def test_members_are_loaded_once_with_pagination(self):
+        slack_client = FakeSlackClient()
+        directory = UserDirectory(slack_client)
+        self.assertEqual("U2", directory.get_id("travel-advisor"))
+        self.assertEqual("alice", directory.get_name("U1"))
+        self.assertEqual(["users.list", "users.list"], [call[0] for call in slack_client.calls])
+
+    def test_unknown_user_is_looked_up(self):
+        slack_client = FakeSlackClient()
+        directory = UserDirectory(slack_client)
+        self.assertEqual("new", directory.get_name("U3"))
+        self.assertEqual("new", directory.get_name("U3"))
+        self.assertEqual(["users.list", "users.list", "users.info"], [call[0] for call in slack_client.calls])
+
+    def test_events_update_directory(self):
+        directory = UserDirectory(FakeSlackClient())
+        directory.load()
+        directory.handle_event({"type": "user_change", "user": {"id": "U1", "name": "alice2"}})
+        directory.handle_event({"type": "team_join", "user": {"id": "U4", "name": "bob"}})
+        self.assertEqual("alice2", directory.get_name("U1"))
+        self.assertIsNone(directory.get_id("alice"))
+        self.assertEqual("U4", directory.get_id("bob"))
+
+    def test_concurrent_callers_wait_for_first_load(self):
+        slack_client = FakeSlackClient(delay=0.05)
+        directory = UserDirectory(slack_client)
+        names = []
+        threads = [threading.Thread(target=lambda: names.append(directory.get_name("U1"))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(["alice"] * 4, names)
+        self.assertEqual(["users.list", "users.list"], [call[0] for call in slack_client.calls])
+
+    def test_failed_load_is_retried(self):
+        slack_client = FakeSlackClient(failures=1)
+        directory = UserDirectory(slack_client)
+        self.assertIsNone(directory.get_id("alice"))
+        self.assertIsNone(directory.get_id("alice"))
+        directory.RETRY_DELAY = 0.0
+        self.assertEqual("U1", directory.get_id("alice"))
+        self.assertEqual(["users.list", "users.list", "users.list"], [call[0] for call in slack_client.calls])